@@ -1,139 +1,583 @@
 ﻿import os
+import json
+import atexit
+import hashlib
+import time
 import asyncio
+import logging
 import threading
-from datetime import datetime
-from flask import Flask, render_template, jsonify, request
+from collections import OrderedDict
+from datetime import datetime, timezone
+from flask import Flask, render_template, jsonify, request, g
 from dotenv import load_dotenv
 from telegram import TelegramHandler
 from email_handler import EmailHandler
-import threading
+from message_index import MessageIndex, format_cursor
+from longpoll import LongPollServer, LONGPOLL_PATH
+from outbox import Outbox
+from history_store import HistoryStore
+from scheduler import SourcePoller
+from compression import encode_body, gzip_bytes, minify_html
+from thumbnails import ThumbnailCache
+import metrics
 
-messages_lock = threading.Lock()
-all_messages = []
 load_dotenv()
 
+# Уровень по умолчанию INFO; DEBUG добавляет подробности каждого цикла опроса и пересборки ответа
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+)
+# aioimaplib на DEBUG пишет каждую строку протокола IMAP
+logging.getLogger('aioimaplib').setLevel(max(logging.getLogger().level, logging.INFO))
+logger = logging.getLogger('app')
+
 app = Flask(__name__)
 
 telegram_handler = TelegramHandler()
 email_handler = EmailHandler()
 
 poll_interval_minutes = int(os.getenv('POLL_INTERVAL_MINUTES', '10'))
+# Свои интервалы и таймауты у каждого источника; интервал сокращается до минимального, пока идут новые сообщения
+telegram_poll_minutes = float(os.getenv('TELEGRAM_POLL_INTERVAL_MINUTES', str(poll_interval_minutes)))
+email_poll_minutes = float(os.getenv('EMAIL_POLL_INTERVAL_MINUTES', str(poll_interval_minutes)))
+poll_min_interval_seconds = int(os.getenv('POLL_MIN_INTERVAL_SECONDS', '60'))
+poll_timeout_seconds = int(os.getenv('POLL_TIMEOUT_SECONDS', '120'))
+poll_max_backoff_seconds = int(os.getenv('POLL_MAX_BACKOFF_MINUTES', '30')) * 60
+pollers = {}
+telegram_reconcile_minutes = int(os.getenv('TELEGRAM_RECONCILE_MINUTES', '60'))
 max_messages_display = int(os.getenv('MAX_MESSAGES_DISPLAY', '15'))
+# Сколько непрочитанных забирать из каждого источника: всё сверх первого экрана доступно страницами
+messages_fetch_limit = int(os.getenv('MESSAGES_FETCH_LIMIT', str(max_messages_display * 2)))
 message_preview_length = int(os.getenv('MESSAGE_PREVIEW_LENGTH', '500'))
 
-async def poll_messages():
-    while True:
-        try:
-            # Увеличиваем лимит выборки: берём в 2 раза больше, чем нужно для отображения
-            telegram_messages = await telegram_handler.fetch_messages(limit=max_messages_display * 2)
-            email_messages = await email_handler.fetch_messages(limit=max_messages_display * 2)
-
-            # Объединяем и сортируем по timestamp (новые сверху)
-            combined = sorted(
-                telegram_messages + email_messages,
-                key=lambda x: x['timestamp'],
-                reverse=True
-            )
+# Общий индекс сообщений всех источников: отсортирован по времени, поиск по id за O(1)
+message_index = MessageIndex(max_size=int(os.getenv('MESSAGE_INDEX_SIZE', '200')))
+# Исходящие сообщения отправляются в фоне; /api/send сразу возвращает id задания
+outbox = Outbox(
+    max_attempts=int(os.getenv('OUTBOX_MAX_ATTEMPTS', '3')),
+    retry_delay=int(os.getenv('OUTBOX_RETRY_SECONDS', '5'))
+)
+
+# Архив всех полученных сообщений для поиска; в индексе выше — только актуальные непрочитанные
+history_store = HistoryStore(os.getenv('HISTORY_STORE_PATH', 'history.sqlite3'))
+search_page_size = int(os.getenv('SEARCH_PAGE_SIZE', '20'))
 
-            # Отладка: выводим источники первых 10 сообщений
-            print(f"[DEBUG] Top 10 message sources: {[m['source'] for m in combined[:10]]}")
+# Миниатюры медиа Telegram под экран 640×960: качаются и уменьшаются только по запросу страницы
+thumb_width, _, thumb_height = os.getenv('THUMBNAIL_SIZE', '640x960').partition('x')
+thumbnail_cache = ThumbnailCache(
+    os.getenv('MEDIA_CACHE_DIR', 'media_cache'),
+    max_size=(int(thumb_width), int(thumb_height)),
+    quality=int(os.getenv('THUMBNAIL_QUALITY', '70')),
+    max_files=int(os.getenv('MEDIA_CACHE_FILES', '1000'))
+)
 
+# JSON меньше порога не сжимаем: заголовки gzip съели бы выигрыш
+gzip_min_bytes = int(os.getenv('GZIP_MIN_BYTES', '1024'))
+page_cache_seconds = int(os.getenv('PAGE_CACHE_SECONDS', str(24 * 60 * 60)))
 
-            with messages_lock:
-                all_messages[:] = combined[:max_messages_display]
+def apply_telegram_changes(added, removed):
+    message_index.update(added=added, removed=removed)
+    if added:
+        history_store.add(added)
 
-            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] "
-                  f"Fetched {len(telegram_messages)} Telegram and {len(email_messages)} email messages "
-                  f"(total in all_messages: {len(all_messages)})")
+telegram_handler.on_change = apply_telegram_changes
+telegram_handler.chat_messages = message_index.chat_messages
 
-        except Exception as e:
-            print(f"Error polling messages: {e}")
+# Готовый JSON для /api/messages пересобирается только при смене версии индекса
+messages_cache = {
+    'version': None, 'updated_at': None, 'body': None, 'body_gzip': None, 'previews': {}, 'order': [], 'next': None
+}
+messages_cache_lock = threading.Lock()
+# Отличает ETag и курсоры разных запусков: версия индекса после перезапуска начинается заново
+boot_id = format(int(time.time()), 'x')
+# Какие превью (по id, в порядке показа) видел клиент на каждой из последних версий — для ответа ?since=<курсор>
+messages_windows = OrderedDict()
+messages_delta_history = int(os.getenv('MESSAGES_DELTA_HISTORY', '100'))
 
-        await asyncio.sleep(poll_interval_minutes * 60)
+async def merge_source(source, messages):
+    """Вливает результат цикла опроса источника в общий индекс и архив."""
+    with metrics.stage('merge'):
+        message_index.replace_source(source, messages)
+        await asyncio.to_thread(history_store.add, messages)
 
+    logger.info("Fetched %d %s messages (total in message_index: %d)",
+                len(messages), source, len(message_index))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Top 10 message sources: %s", [m.source for m in message_index.latest(10)])
 
+def create_pollers():
+    """Каждый источник опрашивается своей задачей: медленный IMAP не задерживает Telegram и наоборот."""
+    # При работающих событиях Telegram полный обход диалогов нужен только для редкой сверки
+    if telegram_handler.events_enabled:
+        telegram_interval = telegram_min_interval = telegram_reconcile_minutes * 60
+    else:
+        telegram_interval = telegram_poll_minutes * 60
+        telegram_min_interval = poll_min_interval_seconds
+
+    return [
+        SourcePoller(
+            'Telegram',
+            # Лимит выборки больше первого экрана: остальное клиент догружает страницами при прокрутке
+            lambda: telegram_handler.fetch_messages(limit=messages_fetch_limit),
+            lambda messages: merge_source('Telegram', messages),
+            interval=telegram_interval,
+            min_interval=telegram_min_interval,
+            timeout=int(os.getenv('TELEGRAM_POLL_TIMEOUT_SECONDS', str(poll_timeout_seconds))),
+            max_backoff=poll_max_backoff_seconds
+        ),
+        SourcePoller(
+            'Email',
+            lambda: email_handler.fetch_messages(limit=messages_fetch_limit),
+            lambda messages: merge_source('Email', messages),
+            interval=email_poll_minutes * 60,
+            min_interval=poll_min_interval_seconds,
+            timeout=int(os.getenv('EMAIL_POLL_TIMEOUT_SECONDS', str(poll_timeout_seconds))),
+            max_backoff=poll_max_backoff_seconds,
+            # Между циклами ждём push от IMAP (IDLE/NOOP) — новое письмо забираем сразу
+            wait=email_handler.wait_for_new_mail
+        ),
+    ]
+
+# Цикл событий, на котором живут обработчики: фоновый поток (WSGI) или цикл ASGI-сервера
+event_loop = None
+
+async def start_services(longpoll=True):
+    """Запускает очередь отправки, Telegram и опрос источников на текущем цикле событий.
+
+    longpoll=False — long-poll обслуживает сам ASGI-сервер (asgi.py), отдельный порт не нужен.
+    """
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+    await outbox.start()
+    await telegram_handler.start()
+    logger.info("Handlers initialized")
+    for poller in create_pollers():
+        pollers[poller.name] = poller
+        poller.start()
+    if not longpoll:
+        longpoll_server.attach()
+    elif longpoll_port:
+        try:
+            await longpoll_server.start(os.getenv('FLASK_HOST', '127.0.0.1'), longpoll_port)
+        except OSError as e:
+            logger.error("Error starting long-poll server: %s", e)
+
+async def stop_services():
+    """Останавливает опрос, даёт очереди дослать сообщения и закрывает сессии Telegram, IMAP и SMTP."""
+    for poller in pollers.values():
+        await poller.stop()
+    await longpoll_server.stop()
+    await outbox.stop()
+    await telegram_handler.stop()
+    await email_handler.close()
+    logger.info("Handlers stopped")
 
 def start_background_loop(loop):
     asyncio.set_event_loop(loop)
     loop.run_forever()
 
-async def init_handlers():
-    await telegram_handler.start()
-    print("Handlers initialized")
-    asyncio.create_task(poll_messages())
+def stop_background_loop(loop):
+    try:
+        asyncio.run_coroutine_threadsafe(stop_services(), loop).result(timeout=20)
+    except Exception as e:
+        logger.error("Error stopping handlers: %s", e)
+
+def log_startup_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Error starting handlers", exc_info=future.exception())
 
 def initialize_async():
+    """WSGI-режим (app.run или WSGI-сервер): обработчики работают на цикле в отдельном потоке."""
     loop = asyncio.new_event_loop()
     thread = threading.Thread(target=start_background_loop, args=(loop,), daemon=True)
     thread.start()
     
-    asyncio.run_coroutine_threadsafe(init_handlers(), loop)
+    future = asyncio.run_coroutine_threadsafe(start_services(), loop)
+    future.add_done_callback(log_startup_error)
+    atexit.register(stop_background_loop, loop)
     return loop
 
-event_loop = initialize_async()
+metrics.MESSAGE_INDEX_SIZE.set_function(lambda: len(message_index))
+metrics.register_pollers(pollers)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unknown'
+        metrics.HTTP_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+        metrics.HTTP_REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+    return response
+
+def make_body_response(body, mimetype='application/json', etag=None, gzipped=None):
+    """Ответ с телом body, сжатым gzip для клиентов, которые его принимают (см. encode_body)."""
+    data, compressed = encode_body(body, request.headers.get('Accept-Encoding'), gzip_min_bytes, gzipped)
+    response = app.response_class(data, mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    if compressed:
+        response.content_encoding = 'gzip'
+    if etag is not None:
+        # У сжатого и несжатого представления разные ETag
+        response.set_etag(f"{etag}-gz" if compressed else etag)
+    return response
+
+def build_index_page():
+    """Страница рендерится один раз при запуске: минифицирована и заранее сжата gzip."""
+    with app.app_context():
+        html = render_template('index.html')
+    body = minify_html(html).encode('utf-8')
+    return {'body': body, 'gzip': gzip_bytes(body, 9), 'etag': hashlib.sha1(body).hexdigest()[:16]}
+
+index_page = build_index_page()
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    response = make_body_response(
+        index_page['body'], mimetype='text/html', etag=index_page['etag'], gzipped=index_page['gzip']
+    )
+    # Страница меняется только с новой версией приложения; после max-age браузер сверяет ETag
+    response.cache_control.public = True
+    response.cache_control.max_age = page_cache_seconds
+    return response.make_conditional(request)
+
+def preview_message(msg):
+    # Словарь превью строится один раз на сообщение и кэшируется в нём самом
+    return msg.to_json(message_preview_length)
+
+def find_message(msg_id):
+    """Сообщение из индекса, а если оно уже прочитано и вытеснено — из архива."""
+    return message_index.get(msg_id) or history_store.get(msg_id)
+
+def messages_cursor(version):
+    return f"{boot_id}-{version}"
+
+def dump_json(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def get_messages_payload():
+    rebuilt = None
+    with messages_cache_lock:
+        if messages_cache['version'] != message_index.version:
+            version, updated_at, latest_messages = message_index.snapshot(max_messages_display + 1)
+            # Курсор следующей страницы есть, только если за первым экраном что-то осталось
+            next_cursor = None
+            if len(latest_messages) > max_messages_display:
+                latest_messages = latest_messages[:max_messages_display]
+                next_cursor = format_cursor(latest_messages[-1])
+            with metrics.stage('api_serialize'):
+                preview_messages = [preview_message(msg) for msg in latest_messages]
+                order = [msg['id'] for msg in preview_messages]
+                body = dump_json({
+                    'version': messages_cursor(version),
+                    'full': True,
+                    'messages': preview_messages,
+                    'count': len(preview_messages),
+                    'next': next_cursor
+                })
+            messages_cache.update(
+                version=version,
+                updated_at=updated_at,
+                body=body,
+                # Полный снимок отдаётся многим клиентам — сжимаем его один раз на версию
+                body_gzip=gzip_bytes(body) if len(body) >= gzip_min_bytes else None,
+                previews={msg['id']: msg for msg in preview_messages},
+                order=order,
+                next=next_cursor
+            )
+            messages_windows[version] = messages_cache['previews']
+            while len(messages_windows) > messages_delta_history:
+                messages_windows.popitem(last=False)
+            rebuilt = (len(preview_messages), version)
+        payload = dict(messages_cache)
+    if rebuilt is not None:
+        logger.debug("Rebuilt messages payload: %d messages, version %d", *rebuilt)
+    return payload
+
+def build_messages_delta(payload, since):
+    """Разница между тем, что клиент видел на версии since, и текущим списком; None — курсор устарел."""
+    since_boot, _, since_version = since.partition('-')
+    if since_boot != boot_id or not since_version.isdigit():
+        return None
+    with messages_cache_lock:
+        old_previews = messages_windows.get(int(since_version))
+    if old_previews is None:
+        return None
+
+    old_order = list(old_previews)
+    # Новые и заменённые под тем же id (например, сверка Telegram уточнила имя чата)
+    added = [
+        payload['previews'][msg_id] for msg_id in payload['order']
+        if old_previews.get(msg_id) != payload['previews'][msg_id]
+    ]
+    removed = [msg_id for msg_id in old_order if msg_id not in payload['previews']]
+    return {
+        'version': messages_cursor(payload['version']),
+        'full': False,
+        'messages': added,
+        'removed': removed,
+        'order': payload['order'],
+        'count': len(payload['order']),
+        'next': payload['next']
+    }, bool(added or removed or old_order != payload['order'])
+
+def render_messages(since=None):
+    """(payload, changed, body): полный снимок или разница относительно курсора since."""
+    payload = get_messages_payload()
+    if since:
+        delta = build_messages_delta(payload, since)
+        if delta is not None:
+            return payload, delta[1], dump_json(delta[0])
+    # Без курсора, со слишком старым или чужим курсором — полный снимок
+    return payload, True, payload['body']
+
+# Long-poll живёт на фоновом asyncio-цикле: ожидающий клиент не занимает поток Flask
+longpoll_port = int(os.getenv('LONGPOLL_PORT', str(int(os.getenv('FLASK_PORT', '5000')) + 1)))
+longpoll_server = LongPollServer(
+    lambda since: render_messages(since)[1:],
+    max_timeout=int(os.getenv('LONGPOLL_MAX_SECONDS', '55')),
+    gzip_min_bytes=gzip_min_bytes
+)
+message_index.add_listener(longpoll_server.notify)
+
+PAGE_ARGS = ('before', 'limit', 'source', 'sender', 'chat_id')
+
+def get_messages_page():
+    """Страница по курсору before=<timestamp>,<id> с фильтрами — прямо из индексов MessageIndex."""
+    limit = min(max(request.args.get('limit', max_messages_display, type=int), 1), 100)
+    # Версия и страница — под одной блокировкой индекса, чтобы ETag соответствовал содержимому
+    with message_index.lock:
+        version = message_index.version
+        found, next_cursor = message_index.page(
+            limit,
+            before=request.args.get('before'),
+            source=request.args.get('source') or None,
+            sender=request.args.get('sender') or None,
+            chat_id=request.args.get('chat_id') or None
+        )
+    with metrics.stage('api_serialize'):
+        previews = [preview_message(msg) for msg in found]
+        body = dump_json({
+            'version': messages_cursor(version),
+            'full': True,
+            'messages': previews,
+            'count': len(previews),
+            'next': next_cursor
+        })
+
+    # Страница меняется только вместе с индексом: версия плюс хэш параметров запроса
+    # (сама строка запроса может содержать кавычки, недопустимые в ETag)
+    query_hash = hashlib.sha1(request.query_string).hexdigest()[:12]
+    response = make_body_response(body, etag=f"{messages_cursor(version)}-{query_hash}")
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/api/messages', methods=['GET'])
 def get_messages():
-    with messages_lock:
-        print(f"[API] Returning {len(all_messages)} messages")  # логирование
-        preview_messages = []
-        for msg in all_messages:
-            preview_msg = msg.copy()
-            if len(preview_msg['text']) > message_preview_length:
-                preview_msg['text'] = preview_msg['text'][:message_preview_length] + '...'
-            preview_messages.append(preview_msg)
-    return jsonify({
-        'messages': preview_messages,
-        'count': len(preview_messages)
-    })
+    if any(name in request.args for name in PAGE_ARGS):
+        return get_messages_page()
 
+    payload, _, body = render_messages(request.args.get('since'))
 
-@app.route('/api/send', methods=['POST'])
-def send_message():
-    data = request.json or {}
+    # Клиент переспрашивает с If-None-Match и получает 304 без тела, пока данные не изменились
+    response = make_body_response(
+        body, etag=messages_cursor(payload['version']),
+        gzipped=payload['body_gzip'] if body is payload['body'] else None
+    )
+    response.last_modified = datetime.fromtimestamp(payload['updated_at'], timezone.utc)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route(LONGPOLL_PATH, methods=['GET'])
+def wait_messages():
+    # Запрос дошёл до Flask — long-poll через прокси не настроен. Отвечаем сразу,
+    # без заголовка X-Long-Poll: страница переключится на опрос по таймеру.
+    _, _, body = render_messages(request.args.get('since'))
+    response = make_body_response(body)
+    response.cache_control.no_store = True
+    return response
+
+
+@app.route('/api/search', methods=['GET'])
+def search_messages():
+    query = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', search_page_size, type=int), 1), 100)
+
+    with metrics.stage('history_search'):
+        found, next_cursor = history_store.search(query, limit=limit, before=request.args.get('before'))
+    logger.debug("Search %r: %d results", query, len(found))
+
+    response = make_body_response(dump_json({
+        'success': True,
+        'query': query,
+        'messages': [preview_message(msg) for msg in found],
+        'count': len(found),
+        'next': next_cursor
+    }))
+    response.cache_control.no_cache = True
+    return response
+
+async def load_message_body(msg_id):
+    """(ответ, статус) для /api/messages/<id>/body; вызывается на цикле обработчиков."""
+    msg = find_message(msg_id)
+    if not msg:
+        return {'success': False, 'error': 'Message not found'}, 404
+
+    if msg.source != 'Email':
+        return {'success': True, 'id': msg_id, 'text': msg.text}, 200
+
+    # Полное тело письма догружаем только по запросу
+    try:
+        body = await asyncio.wait_for(email_handler.fetch_full_body(msg.email_id), 30)
+    except Exception as e:
+        logger.error("Error loading message body: %s", e)
+        body = None
+
+    if body is None:
+        return {'success': False, 'error': 'Failed to load message'}, 500
+    return {'success': True, 'id': msg_id, 'text': f"{msg.subject}\n\n{body}"}, 200
+
+@app.route('/api/messages/<msg_id>/body', methods=['GET'])
+def get_message_body(msg_id):
+    # Поток Flask ждёт цикл обработчиков; в ASGI-режиме asgi.py вызывает load_message_body напрямую
+    future = asyncio.run_coroutine_threadsafe(load_message_body(msg_id), event_loop)
+    payload, status = future.result(timeout=35)
+    # Полный текст письма — самый крупный JSON после списка сообщений
+    return make_body_response(dump_json(payload)), status
+
+
+async def load_thumbnail(msg_id):
+    """JPEG-миниатюра медиа сообщения или None; вызывается на цикле обработчиков."""
+    msg = find_message(msg_id)
+    if not msg or msg.source != 'Telegram' or not msg.media:
+        return None
+
+    key = f"{msg.chat_id}_{msg.message_id}"
+    data = await asyncio.to_thread(thumbnail_cache.get, key)
+    if data is not None:
+        return data
+    try:
+        raw = await asyncio.wait_for(
+            telegram_handler.download_thumbnail(msg.chat_id, msg.message_id, max(thumbnail_cache.max_size)), 30
+        )
+        if raw is None:
+            return None
+        # Pillow — в потоке, чтобы не задерживать цикл с опросом и отправкой
+        with metrics.stage('thumbnail'):
+            return await asyncio.to_thread(thumbnail_cache.put, key, raw)
+    except Exception as e:
+        logger.error("Error loading thumbnail for %s: %s", msg_id, e)
+        return None
+
+# Медиа сообщения не меняется: браузер хранит миниатюру долго и больше не спрашивает
+THUMBNAIL_MAX_AGE = 30 * 24 * 60 * 60
+
+def thumbnail_etag(data):
+    return hashlib.sha1(data).hexdigest()[:16]
+
+def make_thumbnail_response(data):
+    if data is None:
+        return jsonify({'success': False, 'error': 'Thumbnail not available'}), 404
+    response = app.response_class(data, mimetype='image/jpeg')
+    response.cache_control.public = True
+    response.cache_control.max_age = THUMBNAIL_MAX_AGE
+    response.set_etag(thumbnail_etag(data))
+    return response.make_conditional(request)
+
+@app.route('/api/messages/<msg_id>/thumb', methods=['GET'])
+def get_message_thumbnail(msg_id):
+    # В ASGI-режиме asgi.py вызывает load_thumbnail напрямую: поток пула не ждёт цикл,
+    # который сам кладёт Pillow и диск в тот же пул
+    future = asyncio.run_coroutine_threadsafe(load_thumbnail(msg_id), event_loop)
+    return make_thumbnail_response(future.result(timeout=35))
+
+
+def queue_send(data):
+    """(ответ, статус) для /api/send. Потокобезопасна: годится и для Flask, и для цикла событий."""
     text = data.get('text', '')
     reply_to = data.get('reply_to')
     
     if not text:
-        return jsonify({'success': False, 'error': 'No text provided'}), 400
+        return {'success': False, 'error': 'No text provided'}, 400
     
-    async def send():
-        if reply_to:
-            original_msg = next((m for m in all_messages if m['id'] == reply_to), None)
-            if not original_msg:
-                return False
-            
-            if original_msg['source'] == 'Telegram':
-                return await telegram_handler.send_message(
-                    original_msg['chat_id'],
-                    original_msg['message_id'],
+    # Адресата определяем сразу, а саму отправку ставим в очередь — ответ не ждёт SMTP/Telegram
+    if reply_to:
+        original_msg = find_message(reply_to)
+        if not original_msg:
+            return {'success': False, 'error': 'Message not found'}, 404
+        
+        if original_msg.source == 'Telegram':
+            def send():
+                return telegram_handler.send_message(
+                    original_msg.chat_id,
+                    original_msg.message_id,
                     text
                 )
-            elif original_msg['source'] == 'Email':
-                return await email_handler.send_email(
-                    original_msg['sender'],
-                    original_msg.get('subject', 'No Subject'),
+        elif original_msg.source == 'Email':
+            def send():
+                return email_handler.send_email(
+                    original_msg.sender,
+                    original_msg.subject or 'No Subject',
                     text,
-                    in_reply_to=original_msg['email_id']
+                    in_reply_to=original_msg.email_id
                 )
         else:
-            return await telegram_handler.save_to_favorites(text)
+            return {'success': False, 'error': 'Unsupported source'}, 400
+        description = f"{original_msg.source}: {original_msg.sender}"
+    else:
+        def send():
+            return telegram_handler.save_to_favorites(text)
+        description = 'Telegram: Saved Messages'
+    
+    if not outbox.ready:
+        # Запрос пришёл раньше, чем цикл обработчиков запустил очередь отправки, — клиент повторит
+        return {'success': False, 'error': 'Outbox is starting, try again'}, 503
     
     try:
-        future = asyncio.run_coroutine_threadsafe(send(), event_loop)
-        success = future.result(timeout=10)
-        
-        if success:
-            return jsonify({'success': True, 'message': 'Message sent successfully'})
-        else:
-            return jsonify({'success': False, 'error': 'Failed to send message'}), 500
+        job = outbox.submit(send, description)
     except Exception as e:
-        print(f"Error sending message: {e}")
-        return jsonify({'success': False, 'error': str(e)}), 500
+        logger.error("Error queueing message: %s", e)
+        return {'success': False, 'error': str(e)}, 500
+    
+    return {'success': True, 'job_id': job['id'], 'status': job['status']}, 202
+
+@app.route('/api/send', methods=['POST'])
+def send_message():
+    payload, status = queue_send(request.json or {})
+    return jsonify(payload), status
+
+@app.route('/api/send/<job_id>', methods=['GET'])
+def get_send_status(job_id):
+    job = outbox.status(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    
+    response = jsonify({
+        'success': job['status'] != 'failed',
+        'job_id': job['id'],
+        'status': job['status'],
+        'attempts': job['attempts'],
+        'error': job['error']
+    })
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    body, content_type = metrics.render()
+    return app.response_class(body, content_type=content_type)
+
+# Запуск — в самом конце модуля: start_services на фоновом цикле использует всё, что определено выше
+# (long-poll сервер, подписки индекса), и не должен опередить их определение.
+# В ASGI-режиме asgi.py запускает обработчики на цикле сервера (lifespan startup/shutdown).
+# __mp_main__ — app.py, запущенный напрямую, импортирован в воркер разбора писем: обработчики там не нужны
+if os.getenv('SERVER_MODE', 'wsgi') != 'asgi' and __name__ != '__mp_main__':
+    event_loop = initialize_async()
 
 if __name__ == '__main__':
     port = int(os.getenv('FLASK_PORT', '5000'))
@@ -0,0 +1,248 @@
+"""ASGI-режим: HTTP, опрос источников и отправка работают на одном цикле событий.
+
+    uvicorn asgi:application --host 127.0.0.1 --port 5000
+
+Long-poll, отправка, догрузка тела письма и миниатюры медиа обслуживаются прямо на цикле —
+без отдельного порта LONGPOLL_PORT и без перехода между потоками. Остальные маршруты Flask выполняются
+в пуле потоков, а медленные клиенты держат лишь корутину сервера, а не поток.
+
+Сессии Telegram и IMAP принадлежат одному процессу: запускайте сервер с одним воркером
+(конкурентность даёт сам цикл событий).
+"""
+import io
+import os
+import re
+import sys
+import json
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+# До импорта app: фоновый поток с циклом не нужен, обработчики запускает lifespan
+os.environ['SERVER_MODE'] = 'asgi'
+
+import app
+import metrics
+from compression import encode_body
+from longpoll import LONGPOLL_PATH
+
+MESSAGE_BODY_RE = re.compile(r'^/api/messages/([^/]+)/body$')
+MESSAGE_THUMB_RE = re.compile(r'^/api/messages/([^/]+)/thumb$')
+
+logger = logging.getLogger(__name__)
+
+
+def build_environ(scope, body):
+    """WSGI environ для Flask из ASGI-запроса."""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    """Тело запроса целиком; None — клиент отключился раньше."""
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_response(send, status, body, headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-length', str(len(body)).encode('latin-1')), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def send_json(scope, send, status, body, headers=()):
+    # Сжатие — по тем же правилам, что и у ответов Flask (GZIP_MIN_BYTES)
+    body, compressed = encode_body(body, header(scope, b'accept-encoding'), app.gzip_min_bytes)
+    if compressed:
+        headers = [(b'content-encoding', b'gzip'), *headers]
+    await send_response(send, status, body, [
+        (b'content-type', b'application/json'), (b'cache-control', b'no-store'),
+        (b'vary', b'Accept-Encoding'), *headers
+    ])
+
+
+async def call_flask(scope, body, send):
+    """Маршрут Flask в пуле потоков; ответ отправляется уже на цикле событий."""
+    environ = build_environ(scope, body)
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    def run():
+        result = app.app(environ, start_response)
+        try:
+            return b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    content = await asyncio.get_running_loop().run_in_executor(None, run)
+    headers = [
+        (name.lower().encode('latin-1'), value.encode('latin-1'))
+        for name, value in started['headers'] if name.lower() != 'content-length'
+    ]
+    await send_response(send, started['status'], content, headers)
+
+
+async def wait_messages(scope, receive, send):
+    params = parse_qs(scope['query_string'].decode('latin-1'))
+    since = params.get('since', [''])[0]
+    timeout = app.longpoll_server.parse_timeout(params.get('timeout', [None])[0])
+
+    waiter = asyncio.ensure_future(app.longpoll_server.wait(since, timeout))
+    disconnect = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await asyncio.wait((waiter, disconnect), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+    if not waiter.done():
+        # Клиент ушёл раньше — ожидание снимаем сразу, а не по таймауту
+        waiter.cancel()
+        return None
+    # X-Long-Poll: страница продолжит ждать изменений, а не переключится на опрос по таймеру
+    await send_json(scope, send, 200, waiter.result(), [(b'x-long-poll', b'1')])
+    return 200
+
+
+async def send_message(scope, receive, send):
+    body = await read_body(receive)
+    if body is None:
+        return None
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        payload, status = {'success': False, 'error': 'Invalid JSON'}, 400
+    else:
+        payload, status = app.queue_send(data)
+    await send_json(scope, send, status, app.dump_json(payload))
+    return status
+
+
+async def get_message_body(scope, msg_id, send):
+    payload, status = await app.load_message_body(msg_id)
+    await send_json(scope, send, status, app.dump_json(payload))
+    return status
+
+
+async def get_message_thumbnail(scope, msg_id, send):
+    data = await app.load_thumbnail(msg_id)
+    if data is None:
+        payload = {'success': False, 'error': 'Thumbnail not available'}
+        await send_json(scope, send, 404, app.dump_json(payload))
+        return 404
+    etag = f'"{app.thumbnail_etag(data)}"'
+    headers = [
+        (b'cache-control', f'public, max-age={app.THUMBNAIL_MAX_AGE}'.encode('latin-1')),
+        (b'etag', etag.encode('latin-1')),
+    ]
+    if etag in (header(scope, b'if-none-match') or '').split(', '):
+        await send_response(send, 304, b'', headers)
+        return 304
+    await send_response(send, 200, data, [(b'content-type', b'image/jpeg'), *headers])
+    return 200
+
+
+async def handle_http(scope, receive, send):
+    method, path = scope['method'], scope['path']
+    match = MESSAGE_BODY_RE.match(path)
+    thumb_match = MESSAGE_THUMB_RE.match(path)
+    started = asyncio.get_running_loop().time()
+    if method == 'GET' and path == LONGPOLL_PATH:
+        endpoint, status = 'wait_messages', await wait_messages(scope, receive, send)
+    elif method == 'POST' and path == '/api/send':
+        endpoint, status = 'send_message', await send_message(scope, receive, send)
+    elif method == 'GET' and match:
+        endpoint, status = 'get_message_body', await get_message_body(scope, match.group(1), send)
+    elif method == 'GET' and thumb_match:
+        endpoint, status = 'get_message_thumbnail', await get_message_thumbnail(scope, thumb_match.group(1), send)
+    else:
+        # Метрики этих запросов пишет сам Flask (after_request)
+        body = await read_body(receive)
+        if body is not None:
+            await call_flask(scope, body, send)
+        return
+
+    if status is not None:
+        metrics.HTTP_SECONDS.labels(endpoint).observe(asyncio.get_running_loop().time() - started)
+        metrics.HTTP_REQUESTS.labels(endpoint, method, status).inc()
+
+
+async def handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await app.start_services(longpoll=False)
+            except Exception as e:
+                logger.exception("Error starting handlers")
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            try:
+                await app.stop_services()
+            except Exception:
+                logger.exception("Error stopping handlers")
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http':
+        await handle_http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await handle_lifespan(receive, send)
@@ -0,0 +1,231 @@
+import re
+import email
+import asyncio
+from functools import lru_cache
+from email.message import EmailMessage
+from email.utils import format_datetime
+from datetime import datetime, timezone, timedelta
+
+BASE_DATE = datetime(2025, 1, 1, tzinfo=timezone.utc)
+SECTION_RE = re.compile(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?')
+
+
+@lru_cache(maxsize=256)
+def make_mail(number, kind='plain', body_size=2000):
+    """Синтетическое письмо: plain — обычный текст, html — только HTML-часть с «тяжёлой» вёрсткой рассылки."""
+    message = EmailMessage()
+    message['From'] = f'Sender {number} <sender{number}@example.com>'
+    message['To'] = 'me@example.com'
+    message['Subject'] = f'Benchmark message {number}'
+    message['Date'] = format_datetime(BASE_DATE + timedelta(minutes=number))
+    message['Message-ID'] = f'<bench{number}@example.com>'
+    if kind == 'html':
+        row = ('<tr><td style="padding:8px;font-family:Arial"><p>Newsletter item &amp; offer '
+               f'{number}</p><a href="https://example.com/{number}">Read more</a></td></tr>\n')
+        html = ('<html><head><style>' + 'td{color:#333}' * 50 + '</style></head><body><table>' +
+                row * max(1, body_size // len(row)) + '</table></body></html>')
+        message.set_content(html, subtype='html')
+    else:
+        line = f'Line of message {number} with some ordinary text.\n'
+        message.set_content(line * max(1, body_size // len(line)))
+    return message.as_bytes()
+
+
+class Mailbox:
+    def __init__(self, size, kind='plain', body_size=2000):
+        self.kind = kind
+        self.body_size = body_size
+        self.uidvalidity = 1
+        self.modseq = 1
+        # Тела писем строятся при первом FETCH: большим ящикам не нужно держать их все в памяти
+        self.messages = [[uid, set()] for uid in range(1, size + 1)]
+        self.uidnext = size + 1
+
+    def raw(self, uid):
+        return make_mail(uid, self.kind, self.body_size)
+
+    def add(self):
+        uid = self.uidnext
+        self.uidnext += 1
+        self.modseq += 1
+        self.messages.append([uid, set()])
+        return uid
+
+
+class FakeIMAPServer:
+    """Локальный IMAP-сервер без TLS: ровно те команды, что использует EmailHandler.
+
+    Считает команды (round trips), байты в обе стороны и входы в систему.
+    """
+
+    def __init__(self, mailbox, latency=0.0):
+        self.mailbox = mailbox
+        self.latency = latency
+        self.commands = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.logins = 0
+        self.idlers = []
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def reset_counters(self):
+        self.commands = self.bytes_in = self.bytes_out = 0
+
+    def add_message(self):
+        self.mailbox.add()
+        for writer in self.idlers:
+            writer.write(f'* {len(self.mailbox.messages)} EXISTS\r\n'.encode())
+
+    async def _handle(self, reader, writer):
+        def send(data):
+            if isinstance(data, str):
+                data = data.encode()
+            self.bytes_out += len(data)
+            writer.write(data)
+
+        send('* OK fake IMAP ready\r\n')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.bytes_in += len(line)
+                self.commands += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                tag, _, rest = line.decode().rstrip('\r\n').partition(' ')
+                command, _, args = rest.partition(' ')
+                command = command.upper()
+                by_uid = command == 'UID'
+                if by_uid:
+                    command, _, args = args.partition(' ')
+                    command = command.upper()
+
+                if command == 'CAPABILITY':
+                    send(f'* CAPABILITY IMAP4rev1 IDLE CONDSTORE\r\n{tag} OK done\r\n')
+                elif command == 'LOGIN':
+                    self.logins += 1
+                    send(f'{tag} OK logged in\r\n')
+                elif command in ('SELECT', 'EXAMINE'):
+                    box = self.mailbox
+                    send(f'* {len(box.messages)} EXISTS\r\n* OK [UIDVALIDITY {box.uidvalidity}] ok\r\n'
+                         f'* OK [UIDNEXT {box.uidnext}] ok\r\n* OK [HIGHESTMODSEQ {box.modseq}] ok\r\n'
+                         f'{tag} OK [READ-WRITE] done\r\n')
+                elif command == 'NOOP':
+                    send(f'{tag} OK noop\r\n')
+                elif command == 'LOGOUT':
+                    send(f'* BYE\r\n{tag} OK bye\r\n')
+                    await writer.drain()
+                    break
+                elif command == 'IDLE':
+                    send('+ idling\r\n')
+                    self.idlers.append(writer)
+                    while True:
+                        done = await reader.readline()
+                        if not done or done.strip().upper() == b'DONE':
+                            break
+                    self.idlers.remove(writer)
+                    send(f'{tag} OK idle done\r\n')
+                elif command == 'SEARCH':
+                    found = [
+                        str(uid if by_uid else seq)
+                        for seq, (uid, flags) in enumerate(self.mailbox.messages, 1)
+                        if not ('UNSEEN' in args.upper() and '\\Seen' in flags)
+                    ]
+                    send(f'* SEARCH {" ".join(found)}\r\n{tag} OK search\r\n')
+                elif command == 'FETCH':
+                    message_set, _, items = args.partition(' ')
+                    self._fetch(send, tag, message_set, items, by_uid)
+                else:
+                    send(f'{tag} BAD unknown command {command}\r\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        writer.close()
+
+    def _parse_set(self, message_set, by_uid):
+        top = self.mailbox.uidnext if by_uid else len(self.mailbox.messages)
+        numbers = set()
+        for part in message_set.split(','):
+            if ':' in part:
+                first, last = part.split(':')
+                first, last = int(first), top if last == '*' else int(last)
+                numbers.update(range(min(first, last), max(first, last) + 1))
+            else:
+                numbers.add(int(part))
+        return numbers
+
+    def _fetch(self, send, tag, message_set, items, by_uid):
+        wanted = self._parse_set(message_set, by_uid)
+        for seq, (uid, flags) in enumerate(self.mailbox.messages, 1):
+            if (uid if by_uid else seq) not in wanted:
+                continue
+            raw = self.mailbox.raw(uid)
+            parsed = email.message_from_bytes(raw)
+            parts = [f'UID {uid}'.encode()]
+            if 'FLAGS' in items:
+                parts.append(f'FLAGS ({" ".join(sorted(flags))})'.encode())
+            if 'RFC822.SIZE' in items:
+                parts.append(f'RFC822.SIZE {len(raw)}'.encode())
+            if 'BODYSTRUCTURE' in items:
+                parts.append(b'BODYSTRUCTURE ' + bodystructure(parsed))
+            for match in SECTION_RE.finditer(items):
+                section, start, length = match.groups()
+                data = section_bytes(raw, parsed, section)
+                name = f'BODY[{section}]'
+                if start is not None:
+                    data = data[int(start):int(start) + int(length)]
+                    name += f'<{start}>'
+                parts.append(f'{name} {{{len(data)}}}\r\n'.encode() + data)
+            send(f'* {seq} FETCH ('.encode() + b' '.join(parts) + b')\r\n')
+        send(f'{tag} OK fetch done\r\n')
+
+
+def section_bytes(raw, parsed, section):
+    if section == '':
+        return raw
+    if section.upper().startswith('HEADER.FIELDS'):
+        names = re.search(r'\((.*)\)', section).group(1).lower().split()
+        return b''.join(
+            f'{name}: {value}\r\n'.encode() for name, value in parsed.items() if name.lower() in names
+        ) + b'\r\n'
+    part = parsed
+    for number in (int(n) for n in section.split('.')):
+        if part.is_multipart():
+            part = part.get_payload()[number - 1]
+        elif number != 1:
+            return b''
+    payload = part.get_payload(decode=False)
+    return payload.encode('latin-1', 'replace') if isinstance(payload, str) else part.as_bytes()
+
+
+def _quote(value):
+    return b'NIL' if value is None else b'"' + value.encode().replace(b'"', b'\\"') + b'"'
+
+
+def bodystructure(part):
+    if part.is_multipart():
+        return (b'(' + b''.join(bodystructure(p) for p in part.get_payload()) + b' ' +
+                _quote(part.get_content_subtype().upper()) + b')')
+    params = part.get_params()[1:] if part.get_params() else []
+    param_list = (b'(' + b' '.join(_quote(k.upper()) + b' ' + _quote(v) for k, v in params) + b')'
+                  if params else b'NIL')
+    payload = part.get_payload(decode=False)
+    size = len(payload.encode('latin-1', 'replace')) if isinstance(payload, str) else 0
+    encoding = (part.get('Content-Transfer-Encoding') or '7bit').upper()
+    result = (b'(' + _quote(part.get_content_maintype().upper()) + b' ' +
+              _quote(part.get_content_subtype().upper()) + b' ' + param_list + b' NIL NIL ' +
+              _quote(encoding) + b' ' + str(size).encode())
+    if part.get_content_maintype() == 'text':
+        result += b' ' + str(payload.count('\n')).encode()
+    return result + b')'
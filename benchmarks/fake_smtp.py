@@ -0,0 +1,61 @@
+import asyncio
+
+
+class FakeSMTPServer:
+    """Локальный SMTP-сервер без TLS: принимает любые письма, считает соединения и команды."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.connections = 0
+        self.commands = 0
+        self.delivered = 0
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        writer.write(b'220 fake SMTP ready\r\n')
+        in_data = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if in_data:
+                    if line == b'.\r\n':
+                        in_data = False
+                        self.delivered += 1
+                        writer.write(b'250 queued\r\n')
+                        await writer.drain()
+                    continue
+
+                self.commands += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                command = line.decode().strip().upper()
+                if command.startswith(('EHLO', 'HELO')):
+                    writer.write(b'250-fake\r\n250 AUTH PLAIN LOGIN\r\n')
+                elif command.startswith('AUTH'):
+                    writer.write(b'235 authenticated\r\n')
+                elif command == 'DATA':
+                    in_data = True
+                    writer.write(b'354 end with .\r\n')
+                elif command == 'QUIT':
+                    writer.write(b'221 bye\r\n')
+                    await writer.drain()
+                    break
+                else:
+                    writer.write(b'250 ok\r\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
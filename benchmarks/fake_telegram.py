@@ -0,0 +1,54 @@
+import asyncio
+from types import SimpleNamespace
+from datetime import datetime, timezone, timedelta
+from telethon.tl.types import User
+
+BASE_DATE = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeTelegramClient:
+    """Заглушка TelegramClient: диалоги с непрочитанными сообщениями и задержка на каждый запрос."""
+
+    def __init__(self, dialogs=10, unread_per_dialog=3, latency=0.02):
+        self.latency = latency
+        self.requests = 0
+        self.dialogs = []
+        for number in range(dialogs):
+            chat_id = 1000 + number
+            messages = [
+                SimpleNamespace(
+                    id=i + 1, text=f'Hello from chat {number}, message {i + 1}',
+                    date=BASE_DATE + timedelta(minutes=number * 10 + i), sender_id=chat_id,
+                    photo=None, document=None
+                )
+                for i in range(unread_per_dialog)
+            ]
+            self.dialogs.append(SimpleNamespace(
+                id=chat_id, name=f'Chat {number}', entity=User(id=chat_id, first_name=f'Chat {number}'),
+                unread_count=unread_per_dialog, messages=messages
+            ))
+
+    def is_connected(self):
+        return True
+
+    async def iter_dialogs(self):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        for dialog in self.dialogs:
+            yield dialog
+
+    async def iter_messages(self, dialog, limit=None):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        for message in sorted(dialog.messages, key=lambda m: -m.id)[:limit]:
+            yield message
+
+    async def send_message(self, *args, **kwargs):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+    def add_event_handler(self, *args):
+        pass
+
+    async def disconnect(self):
+        pass
@@ -0,0 +1,275 @@
+"""Бенчмарки путей опроса и API на локальных заглушках IMAP/SMTP/Telegram.
+
+    python benchmarks/run.py                          # все наборы, ящики 10/100/1000/10000
+    python benchmarks/run.py --only email,api --sizes 10,1000 --json result.json
+
+Реальные аккаунты не нужны: EmailHandler ходит на локальный IMAP без TLS, TelegramHandler
+получает заглушку клиента, API вызывается через тестовый клиент Flask в том же процессе.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import resource
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+WORKDIR = tempfile.mkdtemp(prefix='ios6-bench-')
+# Настройки до импорта модулей приложения: load_dotenv() не перезаписывает уже заданные переменные
+os.environ.update(
+    TELEGRAM_API_ID='', TELEGRAM_API_HASH='', TELEGRAM_PHONE='',
+    EMAIL_ADDRESS='bench@example.com', EMAIL_PASSWORD='bench',
+    EMAIL_IMAP_SERVER='127.0.0.1', EMAIL_IMAP_SSL='false', EMAIL_SMTP_SERVER='127.0.0.1',
+    EMAIL_STORE_PATH=os.path.join(WORKDIR, 'email_store.sqlite3'),
+    HISTORY_STORE_PATH=os.path.join(WORKDIR, 'history.sqlite3'),
+    TELEGRAM_ENTITY_CACHE_PATH=os.path.join(WORKDIR, 'telegram_entities.sqlite3'),
+    MEDIA_CACHE_DIR=os.path.join(WORKDIR, 'media_cache'),
+    LONGPOLL_PORT='0',
+)
+
+from fake_imap import FakeIMAPServer, Mailbox, make_mail
+from fake_smtp import FakeSMTPServer
+from fake_telegram import FakeTelegramClient
+from email_handler import EmailHandler
+from email_parser import html_to_text
+from telegram import TelegramHandler
+from message import Message
+
+
+class Measure:
+    """Время или пик памяти Python (tracemalloc) и счётчики заглушки за один замер.
+
+    tracemalloc замедляет код в разы, поэтому память меряется отдельным проходом с trace=True,
+    а время берётся из прохода без него.
+    """
+
+    def __init__(self, server=None, trace=False):
+        self.server = server
+        self.trace = trace
+        self.peak = None
+
+    def __enter__(self):
+        if self.server is not None:
+            self.server.reset_counters()
+        if self.trace:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.started
+        if self.trace:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        # Счётчики запоминаем сразу: строки таблицы строятся после всех замеров на том же сервере
+        self.counters = {}
+        if self.server is not None:
+            self.counters = dict(round_trips=self.server.commands, bytes_in=self.server.bytes_in,
+                                 bytes_out=self.server.bytes_out)
+
+    def row(self, memory=None, **extra):
+        """memory — замер того же сценария с trace=True."""
+        row = {'ms': round(self.seconds * 1000, 1), 'peak_kb': memory.peak // 1024 if memory else ''}
+        row.update(self.counters)
+        row.update(extra)
+        return row
+
+
+def new_email_handler(port, smtp_port=None, parse_workers=0):
+    store_path = os.environ['EMAIL_STORE_PATH']
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(store_path + suffix):
+            os.remove(store_path + suffix)
+    handler = EmailHandler()
+    handler.imap_port = port
+    handler.parse_workers = parse_workers
+    if smtp_port is not None:
+        handler.smtp_port = smtp_port
+    return handler
+
+
+async def email_cycles(size, kind, limit, parse_workers, trace):
+    """Три цикла на свежем ящике и пустом хранилище: (замеры cold/unchanged/one new, писем в первом)."""
+    server = await FakeIMAPServer(Mailbox(size, kind=kind, body_size=40000 if kind == 'html' else 2000)).start()
+    handler = new_email_handler(server.port, parse_workers=parse_workers)
+
+    with Measure(server, trace) as cold:
+        fetched = await handler.fetch_messages(limit)
+    with Measure(server, trace) as warm:
+        await handler.fetch_messages(limit)
+    server.add_message()
+    with Measure(server, trace) as incremental:
+        await handler.fetch_messages(limit)
+
+    await handler.close()
+    await server.stop()
+    return (cold, warm, incremental), len(fetched)
+
+
+async def bench_email(sizes, kinds, limit, parse_workers):
+    results = []
+    for kind in kinds:
+        for size in sizes:
+            timed, fetched = await email_cycles(size, kind, limit, parse_workers, trace=False)
+            traced, _ = await email_cycles(size, kind, limit, parse_workers, trace=True)
+            for name, measure, memory in zip(('cold', 'unchanged', 'one new'), timed, traced):
+                results.append(measure.row(memory, bench='email poll', kind=kind, size=size, cycle=name,
+                                           messages=fetched))
+    return results
+
+
+async def bench_telegram(sizes, latency, concurrency):
+    results = []
+    for size in sizes:
+        runs = []
+        for trace in (False, True):
+            handler = TelegramHandler()
+            # Учётные данные только для проверки «Telegram настроен» — подключается заглушка
+            handler.api_id, handler.api_hash, handler.phone = 1, 'bench', '+10000000000'
+            handler.client = FakeTelegramClient(dialogs=size, latency=latency)
+            handler.fetch_concurrency = concurrency
+            with Measure(trace=trace) as measure:
+                fetched = await handler.fetch_messages(limit=30)
+            runs.append((measure, handler.client.requests, len(fetched)))
+        (measure, requests, fetched), (memory, _, _) = runs
+        results.append(measure.row(memory, bench='telegram poll', size=size, cycle='reconcile',
+                                   round_trips=requests, messages=fetched))
+    return results
+
+
+def bench_strip_html(sizes_kb, preview):
+    results = []
+    for size_kb in sizes_kb:
+        raw = make_mail(1, 'html', body_size=size_kb * 1024)
+        markup = raw.split(b'\n\n', 1)[1].decode('utf-8', 'replace')
+        for limit in (preview, None):
+            runs = 5
+            with Measure() as measure:
+                for _ in range(runs):
+                    text = html_to_text(markup, limit)
+            with Measure(trace=True) as memory:
+                html_to_text(markup, limit)
+            results.append(measure.row(memory, bench='strip_html', size=f'{size_kb}KB',
+                                       cycle=f'limit {limit}' if limit else 'full', chars=len(text),
+                                       ms=round(measure.seconds * 1000 / runs, 2)))
+    return results
+
+
+async def smtp_sends(sends, trace):
+    server = await FakeSMTPServer().start()
+    handler = new_email_handler(0, smtp_port=server.port)
+    with Measure(trace=trace) as measure:
+        for number in range(sends):
+            await handler.send_email('to@example.com', f'Bench {number}', 'Reply body')
+    await handler.close()
+    await server.stop()
+    return measure, server
+
+
+async def bench_smtp(sends):
+    measure, server = await smtp_sends(sends, trace=False)
+    memory, _ = await smtp_sends(sends, trace=True)
+    return [measure.row(memory, bench='smtp send', size=sends, cycle='sequential',
+                        ms=round(measure.seconds * 1000 / sends, 2), round_trips=server.commands,
+                        connections=server.connections)]
+
+
+def bench_api(sizes, duration):
+    # Как в ASGI-режиме: без фонового цикла, который начал бы опрашивать источники из .env
+    os.environ['SERVER_MODE'] = 'asgi'
+    import app
+
+    client = app.app.test_client()
+    results = []
+    for size in sizes:
+        # Полный набор вместо индекса: размер ограничен только самим тестом
+        app.message_index.max_size = max(size, app.message_index.max_size)
+        messages = [
+            Message(f'bench_{number}', 'Email' if number % 2 else 'Telegram', f'sender{number % 50}',
+                    1.7e9 + number, body='Synthetic message body ' * 20,
+                    subject='Subject' if number % 2 else None, chat_id=None if number % 2 else number % 40,
+                    message_id=number)
+            for number in range(size)
+        ]
+        app.message_index.replace_source('Email', [m for m in messages if m.source == 'Email'])
+        app.message_index.replace_source('Telegram', [m for m in messages if m.source == 'Telegram'])
+
+        etag = client.get('/api/messages').headers['ETag']
+        cases = (
+            ('full', '/api/messages', {}),
+            ('304', '/api/messages', {'If-None-Match': etag}),
+            ('page+filter', f'/api/messages?source=Email&before={1.7e9 + size // 2!r},x&limit=15', {}),
+        )
+        for name, url, headers in cases:
+            with Measure() as measure:
+                requests = 0
+                deadline = time.perf_counter() + duration
+                while time.perf_counter() < deadline:
+                    client.get(url, headers=headers)
+                    requests += 1
+            with Measure(trace=True) as memory:
+                client.get(url, headers=headers)
+            results.append(measure.row(memory, bench='api /messages', size=size, cycle=name,
+                                       rps=round(requests / measure.seconds),
+                                       ms=round(measure.seconds * 1000 / requests, 3)))
+    return results
+
+
+def print_table(rows):
+    columns = []
+    for row in rows:
+        for key in row:
+            if key not in columns:
+                columns.append(key)
+    widths = {c: max(len(c), *(len(str(r.get(c, ''))) for r in rows)) for c in columns}
+    print('  '.join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        print('  '.join(str(row.get(c, '')).ljust(widths[c]) for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', default='email,telegram,html,smtp,api',
+                        help='наборы через запятую: email, telegram, html, smtp, api')
+    parser.add_argument('--sizes', default='10,100,1000,10000', help='размеры ящиков/диалогов/индекса')
+    parser.add_argument('--kinds', default='plain,html', help='тела писем: plain, html')
+    parser.add_argument('--limit', type=int, default=30, help='лимит выборки писем за цикл (как MESSAGES_FETCH_LIMIT)')
+    parser.add_argument('--parse-workers', type=int, default=0, help='EMAIL_PARSE_WORKERS для EmailHandler')
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help='задержка заглушки Telegram, с')
+    parser.add_argument('--api-seconds', type=float, default=1.0, help='длительность каждого замера API')
+    parser.add_argument('--json', help='сохранить результаты в файл (для сравнения между версиями)')
+    args = parser.parse_args()
+
+    only = set(args.only.split(','))
+    sizes = [int(size) for size in args.sizes.split(',')]
+    rows = []
+    try:
+        if 'email' in only:
+            rows += asyncio.run(bench_email(sizes, args.kinds.split(','), args.limit, args.parse_workers))
+        if 'telegram' in only:
+            rows += asyncio.run(bench_telegram(sizes, args.telegram_latency, 8))
+        if 'html' in only:
+            rows += bench_strip_html([10, 100, 500], int(os.getenv('MESSAGE_PREVIEW_LENGTH', 500)))
+        if 'smtp' in only:
+            rows += asyncio.run(bench_smtp(50))
+        if 'api' in only:
+            rows += bench_api(sizes, args.api_seconds)
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    print_table(rows)
+    print(f"\npeak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MB")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=1, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import re
+import gzip
+
+STYLE_RE = re.compile(r'(<style[^>]*>)(.*?)(</style>)', re.S | re.I)
+SCRIPT_RE = re.compile(r'(<script[^>]*>)(.*?)(</script>)', re.S | re.I)
+HTML_COMMENT_RE = re.compile(r'<!--.*?-->', re.S)
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+CSS_SPACE_RE = re.compile(r'\s*([{};,])\s*')
+CSS_COLON_RE = re.compile(r':\s+')
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def accepts_gzip(accept_encoding):
+    """Есть ли gzip в Accept-Encoding (и не запрещён ли он через q=0)."""
+    for item in (accept_encoding or '').lower().split(','):
+        coding, _, params = item.strip().partition(';')
+        if coding.strip() in ('gzip', 'x-gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+def gzip_bytes(data, level=6):
+    # mtime=0: одинаковое тело сжимается в одинаковые байты
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def encode_body(body, accept_encoding, min_bytes, gzipped=None):
+    """(тело, сжато ли): gzip, если клиент его принимает и тело не меньше min_bytes.
+
+    gzipped — заранее сжатая копия body, чтобы не сжимать одно и то же на каждый запрос.
+    """
+    if len(body) < min_bytes or not accepts_gzip(accept_encoding):
+        return body, False
+    return (gzipped if gzipped is not None else gzip_bytes(body)), True
+
+
+def _minify_css(css):
+    css = CSS_COMMENT_RE.sub('', css)
+    css = WHITESPACE_RE.sub(' ', css)
+    css = CSS_COLON_RE.sub(':', CSS_SPACE_RE.sub(r'\1', css))
+    return css.replace(';}', '}').strip()
+
+
+def _minify_lines(text, comment=None):
+    # Переводы строк сохраняются: в JS на них держится автоматическая вставка точек с запятой
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line and not (comment and line.startswith(comment)))
+
+
+def minify_html(html):
+    """Консервативная минификация страницы: без отступов, пустых строк и комментариев.
+
+    CSS сжимается полностью, в JS убираются только отступы и строки-комментарии.
+    """
+    html = html.lstrip('\ufeff')
+    blocks = []
+
+    def keep(match, body):
+        blocks.append(match.group(1) + body + match.group(3))
+        return f'\x00{len(blocks) - 1}\x00'
+
+    html = STYLE_RE.sub(lambda m: keep(m, _minify_css(m.group(2))), html)
+    html = SCRIPT_RE.sub(lambda m: keep(m, _minify_lines(m.group(2), comment='//')), html)
+    html = _minify_lines(HTML_COMMENT_RE.sub('', html))
+    return re.sub(r'\x00(\d+)\x00', lambda m: blocks[int(m.group(1))], html)
@@ -1,323 +1,697 @@
 ﻿import os
 import asyncio
 import re
-import email
-import html
-from email.header import decode_header
-from email.utils import parsedate_to_datetime, parseaddr
-from datetime import datetime
+import logging
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, BrokenExecutor
 from aioimaplib import aioimaplib
-from aiosmtplib import SMTP
+from aiosmtplib import SMTP, SMTPServerDisconnected, SMTPConnectError
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from dotenv import load_dotenv
+from email_store import EmailStore
+from email_parser import (
+    html_to_text, decode_subject, get_email_body, build_record, body_text, message_text, run_timed
+)
+import metrics
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+SELECT_STATUS_RE = re.compile(rb'\[(UIDVALIDITY|UIDNEXT|HIGHESTMODSEQ) (\d+)\]')
+FETCH_START_RE = re.compile(rb'^\d+ FETCH \(')
+FETCH_UID_RE = re.compile(rb'\bUID (\d+)')
+FETCH_FLAGS_RE = re.compile(rb'\bFLAGS \(([^)]*)\)')
+FETCH_SIZE_RE = re.compile(rb'\bRFC822\.SIZE (\d+)')
+FETCH_LITERAL_RE = re.compile(rb'(BODY\[[^\]]*\](?:<\d+>)?) \{\d+\}$')
+LITERAL_RE = re.compile(rb'\{\d+\}$')
+IMAP_ATOM_RE = re.compile(rb'[^\s()"]+')
+HEADER_FIELDS = 'From To Cc Subject Date'
+
+
+def format_uid_set(uids):
+    """[1, 2, 3, 7, 9, 10] -> '1:3,7,9:10'"""
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(a) if a == b else f'{a}:{b}' for a, b in ranges)
+
+
+def parse_fetch_response(lines):
+    """Разбирает ответ FETCH на несколько писем: литералы (bytearray) идут сразу за строкой с {size}."""
+    items = []
+    current = None
+    pending_section = None
+    for line in lines:
+        if isinstance(line, bytearray):
+            if current is not None and pending_section is not None:
+                current['sections'][pending_section] = bytes(line)
+            elif current is not None and current['text'] and LITERAL_RE.search(current['text'][-1]):
+                # Литерал внутри BODYSTRUCTURE (например, имя файла) — встраиваем как строку
+                quoted = b'"' + bytes(line).replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+                current['text'][-1] = LITERAL_RE.sub(lambda _: quoted, current['text'][-1])
+            pending_section = None
+            continue
+
+        if FETCH_START_RE.match(line):
+            current = {'uid': None, 'flags': '', 'size': None, 'sections': {}, 'text': []}
+            items.append(current)
+        if current is None:
+            continue
+
+        match = FETCH_LITERAL_RE.search(line)
+        if match:
+            pending_section = match.group(1).decode(errors='replace').upper()
+            line = line[:match.start()]
+        current['text'].append(bytes(line))
+
+    for item in items:
+        text = b''.join(item.pop('text'))
+        item['text'] = text
+        match = FETCH_UID_RE.search(text)
+        if match:
+            item['uid'] = int(match.group(1))
+        match = FETCH_FLAGS_RE.search(text)
+        if match:
+            item['flags'] = match.group(1).decode(errors='replace')
+        match = FETCH_SIZE_RE.search(text)
+        if match:
+            item['size'] = int(match.group(1))
+    return items
+
+
+def fetch_section(item, prefix):
+    for name, data in item['sections'].items():
+        if name.startswith(prefix):
+            return data
+    return None
+
+
+def parse_imap_list(data, pos=0):
+    """Разбирает скобочное выражение IMAP (BODYSTRUCTURE) в вложенные списки: NIL -> None, строки -> str."""
+    result = []
+    length = len(data)
+    while pos < length:
+        char = data[pos:pos + 1]
+        if char == b'(':
+            sublist, pos = parse_imap_list(data, pos + 1)
+            result.append(sublist)
+        elif char == b')':
+            return result, pos + 1
+        elif char == b'"':
+            end = pos + 1
+            value = bytearray()
+            while end < length and data[end:end + 1] != b'"':
+                if data[end:end + 1] == b'\\':
+                    end += 1
+                value += data[end:end + 1]
+                end += 1
+            result.append(value.decode('utf-8', errors='replace'))
+            pos = end + 1
+        elif char in (b' ', b'\r', b'\n'):
+            pos += 1
+        else:
+            match = IMAP_ATOM_RE.match(data, pos)
+            atom = match.group(0).decode(errors='replace')
+            result.append(None if atom.upper() == 'NIL' else atom)
+            pos = match.end()
+    return result, pos
+
+
+def parse_bodystructure(text):
+    index = text.find(b'BODYSTRUCTURE (')
+    if index < 0:
+        return None
+    parsed, _ = parse_imap_list(text, index + len(b'BODYSTRUCTURE ('))
+    return parsed
+
+
+def _is_attachment(fields):
+    return any(
+        isinstance(field, list) and field and isinstance(field[0], str) and field[0].upper() == 'ATTACHMENT'
+        for field in fields
+    )
+
+
+def iter_text_parts(structure, section=''):
+    if not structure:
+        return
+    if isinstance(structure[0], list):
+        # multipart: сначала вложенные части, затем подтип
+        for index, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            yield from iter_text_parts(child, f'{section}.{index}' if section else str(index))
+        return
+
+    content_type = (structure[0] or '').lower()
+    subtype = (structure[1] or '').lower()
+    if content_type != 'text' or subtype not in ('plain', 'html') or _is_attachment(structure[7:]):
+        return
+    params = structure[2] if isinstance(structure[2], list) else []
+    charset = None
+    for key, value in zip(params[::2], params[1::2]):
+        if isinstance(key, str) and key.lower() == 'charset':
+            charset = value
+    yield {
+        'section': section or '1',
+        'subtype': subtype,
+        'encoding': (structure[5] or '7BIT').upper(),
+        'charset': charset or 'utf-8',
+    }
+
+
+def find_text_part(structure):
+    """Ищет text/plain (или text/html, если простого текста нет), пропуская вложения."""
+    parts = list(iter_text_parts(structure))
+    for part in parts:
+        if part['subtype'] == 'plain':
+            return part
+    return parts[0] if parts else None
+
+
 class EmailHandler:
     def __init__(self):
         self.imap_server = os.getenv('EMAIL_IMAP_SERVER', 'imap.yandex.ru')
         self.imap_port = int(os.getenv('EMAIL_IMAP_PORT', 993))
+        self.imap_ssl = os.getenv('EMAIL_IMAP_SSL', 'true').lower() not in ('0', 'false', 'no')
         self.smtp_server = os.getenv('EMAIL_SMTP_SERVER', 'smtp.yandex.ru')
         self.smtp_port = int(os.getenv('EMAIL_SMTP_PORT', 465))
         self.email_address = os.getenv('EMAIL_ADDRESS')
         self.email_password = os.getenv('EMAIL_PASSWORD')
         self.messages = []
-        
-    def strip_html(self, html):
-        if not html:
-            return ""
 
-        # 1. Заменяем <br>, <div>, <p> и подобные на переносы строк
-        html = re.sub(r'<br\s*/?>', '\n', html, flags=re.IGNORECASE)
-        html = re.sub(r'</(div|p|li|tr|td|th)>', '\n', html, flags=re.IGNORECASE)
-        html = re.sub(r'<(div|p|li|tr|td|th)[^>]*>', '', html, flags=re.IGNORECASE)
+        # Долгоживущая IMAP-сессия: переиспользуется между циклами опроса
+        self.idle_timeout = int(os.getenv('EMAIL_IDLE_TIMEOUT_SECONDS', 25 * 60))
+        self.noop_interval = int(os.getenv('EMAIL_NOOP_INTERVAL_SECONDS', 60))
+        self.imap_client = None
+        self._imap_lock = asyncio.Lock()
+        self._imap_last_used = 0.0
+        self._idling_client = None
+        # Сколько команд ждут соединение: IDLE, начатый до их прихода, завершается сразу
+        self._imap_pending = 0
+
+        # Инкрементальная синхронизация по UID: разобранные письма хранятся локально
+        self.store = EmailStore(os.getenv('EMAIL_STORE_PATH', 'email_store.sqlite3'))
+        self._select_status = None
+
+        # Пакетная выборка: сколько писем в одном UID FETCH и сколько байт текстовой части брать на письмо
+        self.fetch_batch_size = int(os.getenv('EMAIL_FETCH_BATCH_SIZE', 50))
+        self.fetch_body_bytes = int(os.getenv('EMAIL_FETCH_BODY_BYTES', 16384))
+        # Текст HTML-писем для превью дальше этой длины не разбираем
+        self.preview_length = int(os.getenv('MESSAGE_PREVIEW_LENGTH', 500))
+
+        # Разбор MIME/HTML выносится из asyncio-цикла: thread (по умолчанию) или process
+        self.parse_executor_kind = os.getenv('EMAIL_PARSE_EXECUTOR', 'thread')
+        self.parse_workers = int(os.getenv('EMAIL_PARSE_WORKERS', min(4, os.cpu_count() or 1)))
+        self._parse_executor = None
+
+        # Долгоживущая SMTP-сессия для ответов
+        self.smtp_timeout = int(os.getenv('EMAIL_SMTP_TIMEOUT_SECONDS', 30))
+        self.smtp_keepalive = int(os.getenv('EMAIL_SMTP_KEEPALIVE_SECONDS', 60))
+        self.smtp_client = None
+        self._smtp_lock = asyncio.Lock()
+        self._smtp_keepalive_task = None
+
+    def strip_html(self, markup, limit=None):
+        return html_to_text(markup, limit)
 
-        # 2. Удаляем все остальные теги
-        html = re.sub(r'<[^>]+>', '', html)
+    def decode_subject(self, subject):
+        return decode_subject(subject)
 
-        # 3. Декодируем HTML‑сущности
+    def get_email_body(self, msg):
+        return get_email_body(msg)
+
+    def _get_parse_executor(self):
+        # Пул создаётся лениво, при первом разборе; 0 воркеров — разбор прямо в цикле
+        if self._parse_executor is None and self.parse_workers > 0:
+            if self.parse_executor_kind == 'thread':
+                self._parse_executor = ThreadPoolExecutor(self.parse_workers, thread_name_prefix='email-parse')
+            else:
+                # Не fork: в процессе уже работают потоки Flask и цикла обработчиков.
+                # Сервер forkserver заранее импортирует только email_parser, воркеры ответвляются от него
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['email_parser'])
+                self._parse_executor = ProcessPoolExecutor(self.parse_workers, mp_context=context)
+        return self._parse_executor
+
+    async def _parse(self, func, *args):
+        """Выполняет CPU-ёмкий разбор в пуле, чтобы не блокировать цикл с Telegram и отправкой."""
+        executor = self._get_parse_executor()
         try:
-            # Python 3.4+: используем html.unescape()
-            html = html.unescape(html)
-        except AttributeError:
-            # Для старых версий Python: эмулируем unescape через замену сущностей
-            html = self._unescape_html_entities(html)
-
-        # 4. Удаляем оставшиеся сущности, которые не удалось декодировать (на всякий случай)
-        html = re.sub(r'&\w+;', ' ', html)  # например, &nbsp;, &quot;
-        html = re.sub(r'&#\d+;', ' ', html)   # числовые сущности, например, &#160;
-
-        # 5. Нормализуем пробелы и переносы
-        html = re.sub(r'\s+', ' ', html).strip()        # множественные пробелы → один пробел
-        html = re.sub(r' *\n *', '\n', html)           # пробелы вокруг \n → чистый \n
-        html = re.sub(r'\n+', '\n', html).strip()       # множественные \n → один \n
-
-        return html
-
-
-    def _unescape_html_entities(self, text):
-        """Ручная замена HTML-сущностей для старых версий Python."""
-        # Словарь базовых сущностей
-        entity_map = {
-            '&amp;': '&',
-            '&lt;': '<',
-            '&gt;': '>',
-            '&quot;': '"',
-            '&apos;': "'",
-            '&nbsp;': ' ',
-            '&copy;': '©',
-            '&reg;': '®',
-            '&euro;': '€',
-            '&pound;': '£',
-            '&yen;': '¥',
-            '&cent;': '¢',
-            '&sect;': '§',
-            '&para;': '¶',
-            '&deg;': '°',
-            '&plusmn;': '±',
-            '&times;': '×',
-            '&divide;': '÷',
-            '&frac12;': '½',
-            '&frac14;': '¼',
-            '&frac34;': '¾',
-            '&hellip;': '…',
-            '&ndash;': '–',
-            '&mdash;': '—',
-            '&lsquo;': '‘',
-            '&rsquo;': '’',
-            '&ldquo;': '“',
-            '&rdquo;': '”',
-            '&bull;': '•',
-            '&trade;': '™',
-            '&rarr;': '→',
-            '&larr;': '←',
-            '&uarr;': '↑',
-            '&darr;': '↓',
-        }
-
-        for entity, char in entity_map.items():
-            text = text.replace(entity, char)
-
-        # Обрабатываем числовые сущности (&#160;)
-        import re
-        def replace_numeric(match):
-            code = int(match.group(1))
-            return chr(code) if 0 <= code <= 0x10FFFF else ' '
-
-        text = re.sub(r'&#(\d+);', replace_numeric, text)
-
-        return text
+            if executor is None:
+                result, times = run_timed(func, *args)
+            else:
+                loop = asyncio.get_running_loop()
+                result, times = await loop.run_in_executor(executor, run_timed, func, *args)
+        except BrokenExecutor as e:
+            logger.error("Email parse pool failed (%s), recreating", e)
+            self._parse_executor = None
+            result, times = run_timed(func, *args)
+        for stage, seconds in times.items():
+            metrics.observe_stage(stage, seconds)
+        return result
+
+    def _imap_alive(self):
+        client = self.imap_client
+        if client is None or client.protocol is None:
+            return False
+        transport = client.protocol.transport
+        if transport is None or transport.is_closing():
+            return False
+        return client.get_state() == 'SELECTED'
 
+    async def _connect_imap(self):
+        await self._drop_imap()
 
-    def decode_subject(self, subject):
-        if subject is None:
-            return "No Subject"
+        # Без SSL — только для локальных серверов (например, тестовых стендов в benchmarks/)
+        imap_class = aioimaplib.IMAP4_SSL if self.imap_ssl else aioimaplib.IMAP4
+        with metrics.stage('imap_connect'):
+            imap_client = imap_class(host=self.imap_server, port=self.imap_port)
+            await imap_client.wait_hello_from_server()
+
+        with metrics.stage('imap_login'):
+            status, data = await imap_client.login(self.email_address, self.email_password)
+        if status != 'OK':
+            raise aioimaplib.Error(f"IMAP login failed: {data}")
+
+        self._select_status = await self._select_inbox(imap_client)
+        self.imap_client = imap_client
+        self._imap_last_used = asyncio.get_running_loop().time()
+        logger.info("IMAP session established (IDLE: %s)", imap_client.has_capability('IDLE'))
+        return imap_client
+
+    async def _select_inbox(self, imap_client):
+        mailbox = 'INBOX (CONDSTORE)' if imap_client.has_capability('CONDSTORE') else 'INBOX'
+        with metrics.stage('imap_select'):
+            status, data = await imap_client.select(mailbox)
+        if status != 'OK':
+            raise aioimaplib.Error(f"IMAP select failed: {data}")
+
+        select_status = {'uidvalidity': None, 'uidnext': None, 'highestmodseq': None}
+        for line in data:
+            for key, value in SELECT_STATUS_RE.findall(bytes(line)):
+                select_status[key.decode().lower()] = int(value)
+        return select_status
+
+    async def _drop_imap(self):
+        imap_client = self.imap_client
+        if imap_client is None:
+            return
+        self.imap_client = None
         try:
-            decoded_parts = decode_header(subject)
-            decoded_subject = ""
-            for part, encoding in decoded_parts:
-                if isinstance(part, bytes):
-                    decoded_subject += part.decode(encoding or 'utf-8', errors='replace')
-                else:
-                    decoded_subject += str(part)
-            return decoded_subject
-        except Exception as e:
-            print(f"[ERROR] Decoding subject: {e}")
-            return str(subject)
+            await asyncio.wait_for(imap_client.logout(), 5)
+        except Exception:
+            pass
+        self._abort_imap(imap_client)
+
+    def _abort_imap(self, imap_client=None):
+        """Закрывает соединение без LOGOUT — когда сессия осталась посреди команды."""
+        if imap_client is None:
+            imap_client, self.imap_client = self.imap_client, None
+        if imap_client is None:
+            return
+        transport = imap_client.protocol.transport if imap_client.protocol else None
+        if transport is not None:
+            transport.close()
+
+    async def _get_imap_client(self):
+        if not self._imap_alive():
+            return await self._connect_imap()
+
+        # Соединение могло тихо умереть на стороне сервера — проверяем NOOP после простоя
+        loop = asyncio.get_running_loop()
+        if loop.time() - self._imap_last_used > self.noop_interval:
+            try:
+                status, _ = await self.imap_client.noop()
+                if status != 'OK':
+                    raise aioimaplib.Error('NOOP failed')
+            except Exception as e:
+                logger.info("IMAP session is stale (%s), reconnecting", e)
+                return await self._connect_imap()
+        self._imap_last_used = loop.time()
+        return self.imap_client
+
+    async def _acquire_imap(self):
+        """Захватывает соединение для команды, прерывая IDLE, если он идёт или только начинается."""
+        self._imap_pending += 1
+        try:
+            # IDLE занимает соединение целиком. Если IDLE ещё ждёт ответа сервера на idle_start,
+            # _idle_once сам увидит _imap_pending и завершится
+            if self._idling_client is not None:
+                await self._idling_client.stop_wait_server_push()
+            await self._imap_lock.acquire()
+        finally:
+            self._imap_pending -= 1
+
+    @contextlib.asynccontextmanager
+    async def _imap_session(self):
+        await self._acquire_imap()
+        try:
+            yield await self._get_imap_client()
+        except (OSError, asyncio.TimeoutError, aioimaplib.AioImapException):
+            # Сетевые ошибки: сбрасываем сессию, следующий вызов переподключится
+            await self._drop_imap()
+            raise
+        except asyncio.CancelledError:
+            # Цикл опроса прерван по таймауту посреди команды — ответы сервера уже не разобрать
+            self._abort_imap()
+            raise
+        else:
+            self._imap_last_used = asyncio.get_running_loop().time()
+        finally:
+            self._imap_lock.release()
+
+    @staticmethod
+    def _is_mailbox_change(push):
+        return any(
+            isinstance(line, (bytes, bytearray)) and
+            (b'EXISTS' in line or b'RECENT' in line or b'EXPUNGE' in line or b'FETCH' in line)
+            for line in push
+        )
+
+    async def _idle_once(self, imap_client, timeout):
+        idle = await imap_client.idle_start(timeout=timeout)
+        self._idling_client = imap_client
+        changed = False
+        try:
+            # Команда пришла, пока сервер подтверждал IDLE, — stop до неё не дошёл бы
+            while imap_client.has_pending_idle() and not self._imap_pending:
+                push = await imap_client.wait_server_push()
+                if push == aioimaplib.STOP_WAIT_SERVER_PUSH:
+                    break
+                if self._is_mailbox_change(push):
+                    changed = True
+                    break
+        finally:
+            self._idling_client = None
+            imap_client.idle_done()
+            await asyncio.wait_for(idle, 10)
+        return changed
+
+    async def wait_for_new_mail(self, timeout):
+        """Ждёт изменений в INBOX (IDLE или NOOP-опрос). True — есть изменения, False — таймаут."""
+        loop = asyncio.get_running_loop()
+        if not self.email_address or not self.email_password:
+            await asyncio.sleep(timeout)
+            return False
 
-    def get_email_body(self, msg):
-        body = ""
-        if msg.is_multipart():
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                content_disposition = str(part.get("Content-Disposition", "")).lower()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
 
-                if content_type == "text/plain" and "attachment" not in content_disposition:
+            try:
+                async with self._imap_lock:
                     try:
-                        payload = part.get_payload(decode=True)
-                        if isinstance(payload, bytes):
-                            body = payload.decode('utf-8', errors='ignore')
+                        imap_client = await self._get_imap_client()
+                        if imap_client.has_capability('IDLE'):
+                            changed = await self._idle_once(imap_client, min(remaining, self.idle_timeout))
                         else:
-                            body = str(payload)
-                        break
-                    except Exception as e:
-                        print(f"[ERROR] Decoding part: {e}")
-                        continue
-        else:
-            try:
-                payload = msg.get_payload(decode=True)
-                if isinstance(payload, bytes):
-                    body = payload.decode('utf-8', errors='ignore')
-                else:
-                    body = str(payload)
+                            status, data = await imap_client.noop()
+                            changed = status == 'OK' and self._is_mailbox_change(data)
+                    except asyncio.CancelledError:
+                        # Остановка опроса посреди IDLE (в том числе до ответа '+' на idle_start):
+                        # соединение осталось в IDLE, и следующая команда на нём зависла бы
+                        self._abort_imap()
+                        raise
+                    self._imap_last_used = loop.time()
+
+                if changed:
+                    return True
+                if not imap_client.has_capability('IDLE'):
+                    # Сервер без IDLE: опрашиваем NOOP, не удерживая соединение
+                    await asyncio.sleep(min(remaining, self.noop_interval))
+
             except Exception as e:
-                print(f"[ERROR] Getting payload: {e}")
-                body = str(msg.get_payload())
-        return body.strip()
+                logger.error("IMAP wait failed: %s: %s", type(e).__name__, e)
+                async with self._imap_lock:
+                    await self._drop_imap()
+                await asyncio.sleep(min(max(remaining, 0), 30))
 
     async def fetch_messages(self, limit=10):
         if not self.email_address or not self.email_password:
-            print("WARNING: Email credentials not configured. Skipping email integration.")
+            logger.warning("Email credentials not configured. Skipping email integration.")
             return []
 
-        try:
-            imap_client = aioimaplib.IMAP4_SSL(host=self.imap_server, port=self.imap_port)
-            await imap_client.wait_hello_from_server()
-            await imap_client.login(self.email_address, self.email_password)
-            await imap_client.select('INBOX')
-
+        # Одна повторная попытка: если сессия оборвалась, переподключаемся
+        for attempt in range(2):
+            try:
+                async with self._imap_session() as imap_client:
+                    return await self._fetch_unseen(imap_client, limit)
+            except (OSError, asyncio.TimeoutError, aioimaplib.AioImapException) as e:
+                logger.error("IMAP session failed (attempt %d): %s: %s", attempt + 1, type(e).__name__, e)
+                if attempt:
+                    # Ошибку отдаём планировщику опроса — он отложит следующий цикл
+                    raise
+            except Exception:
+                logger.exception("Error fetching email messages")
+                raise
+
+    async def _fetch_unseen(self, imap_client, limit):
+        # Свежий SELECT после подключения переиспользуем, иначе перечитываем UIDNEXT/HIGHESTMODSEQ
+        select_status, self._select_status = self._select_status, None
+        if select_status is None:
+            select_status = await self._select_inbox(imap_client)
+
+        state = self.store.get_state('INBOX')
+        if state is not None and state['uidvalidity'] != select_status['uidvalidity']:
+            logger.info("UIDVALIDITY changed, dropping local email cache")
+            self.store.reset('INBOX')
+            state = None
+        cached_uids = self.store.uids('INBOX')
+
+        # С CONDSTORE неизменные UIDNEXT и HIGHESTMODSEQ означают, что в ящике ничего не поменялось
+        unchanged = (
+            state is not None
+            and select_status['highestmodseq'] is not None
+            and state['uidnext'] == select_status['uidnext']
+            and state['highestmodseq'] == select_status['highestmodseq']
+            and len(cached_uids) >= limit
+        )
+        if unchanged:
+            logger.debug("Mailbox unchanged since last poll, using local cache")
+            unseen_uids = cached_uids
+        else:
             # Ищем только непрочитанные письма
-            status, data = await imap_client.search('UNSEEN')
+            with metrics.stage('imap_search'):
+                status, data = await imap_client.uid_search('UNSEEN')
             if status != 'OK':
-                print(f"[ERROR] IMAP search failed: {data}")
-                await imap_client.logout()
+                logger.error("IMAP search failed: %s", data)
                 return []
+            unseen_uids = {int(uid) for uid in data[0].split()} if data[0] else set()
+
+            # Прочитанные или удалённые с момента прошлого опроса убираем из кэша
+            gone_uids = cached_uids - unseen_uids
+            if gone_uids:
+                self.store.delete('INBOX', gone_uids)
+
+        target_uids = sorted(unseen_uids)[-limit:]
+        new_uids = [uid for uid in target_uids if uid not in cached_uids]
+        logger.debug("Found %d unread emails, %d new", len(unseen_uids), len(new_uids))
+
+        fetched = await self._fetch_by_uid(imap_client, new_uids)
+        self.store.save('INBOX', fetched)
+        self.store.set_state(
+            'INBOX', select_status['uidvalidity'], select_status['uidnext'], select_status['highestmodseq']
+        )
+
+        messages = self.store.load('INBOX', target_uids)
+        messages.sort(key=lambda x: x.timestamp, reverse=True)
+        self.messages = messages[:limit]
+        return self.messages
+
+    async def _fetch_by_uid(self, imap_client, uids):
+        # Один UID FETCH на пачку писем вместо трёх запросов на каждое
+        fetched = []
+        for i in range(0, len(uids), self.fetch_batch_size):
+            uid_set = format_uid_set(uids[i:i + self.fetch_batch_size])
+            with metrics.stage('imap_fetch'):
+                status, data = await imap_client.uid(
+                    'fetch',
+                    uid_set,
+                    f'(UID FLAGS RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])'
+                )
+            if status != 'OK':
+                logger.error("Batch fetch failed for UIDs %s: %s", uid_set, data)
+                continue
 
-            email_ids = data[0].decode().split() if data[0] else []
-            print(f"[INFO] Found {len(email_ids)} unread emails")
-
-            messages = []
-
-            for email_id in email_ids[-limit:]:
-                try:
-                    # 1. Проверяем текущие флаги (опционально)
-                    status, flags_data = await imap_client.fetch(email_id, '(FLAGS)')
-                    if status == 'OK':
-                        flags = flags_data[0].decode()
-                        if '\\Seen' in flags:
-                            print(f"[SKIP] Email {email_id} already read, skipping")
-                            continue
-
-                    # 2. Запрашиваем только заголовки и размер (безопаснее)
-                    status, msg_data = await imap_client.fetch(
-                        email_id,
-                        '(BODY.PEEK[HEADER.FIELDS (From To Cc Subject Date)] RFC822.SIZE)'
-                    )
-                    if status != 'OK':
-                        print(f"[SKIP] Fetch headers failed for ID {email_id}: {msg_data}")
-                        continue
-
-                    # Извлекаем заголовки (надёжная версия)
-                    headers = None
-                    for part in msg_data:
-                        if isinstance(part, bytearray):
-                            if b'BODY[' in part or any(header_key in part for header_key in [b'From:', b'To:', b'Subject:', b'Date:']):
-                                headers = part
-                                break
-
-                    if not headers:
-                        print(f"[SKIP] No headers found for ID {email_id}")
-                        continue
-
-                    # Парсим заголовки
-                    try:
-                        msg = email.message_from_bytes(headers, policy=email.policy.default)
-                    except Exception as e:
-                        print(f"[ERROR] Failed to parse headers for ID {email_id}: {e}")
-                        continue
-
-                    subject = self.decode_subject(msg.get('Subject', 'No Subject'))
-                    from_addr = parseaddr(msg.get('From'))[1] or 'Unknown'
-                    date_str = msg.get('Date', '')
-
-
-                    # Парсим дату
-                    try:
-                        date_obj = parsedate_to_datetime(date_str)
-                        if date_obj is None:
-                            date_obj = datetime.now()
-                        timestamp = date_obj.timestamp()
-                        date_iso = date_obj.isoformat()
-                    except (ValueError, TypeError, OverflowError) as e:
-                        print(f"[ERROR] Parsing date '{date_str}': {e}")
-                        date_obj = datetime.now()
-                        timestamp = date_obj.timestamp()
-                        date_iso = date_obj.isoformat()
-
-                    # 3. Если нужно тело — запрашиваем отдельно (менее агрессивно)
-                    body = ""
-                    status, body_data = await imap_client.fetch(email_id, '(BODY.PEEK[])')
-                    if status == 'OK':
-                        for part in body_data:
-                            if isinstance(part, bytearray):
-                                raw_body = bytes(part)
-                                msg_body = email.message_from_bytes(raw_body, policy=email.policy.default)
-                                raw_body = self.get_email_body(msg_body)
-                                body = self.strip_html(raw_body)
-                                break
-
-                    messages.append({
-                        'id': f"email_msg_{email_id}",
-                        'source': 'Email',
-                        'source_name': from_addr,
-                        'sender': from_addr,
-                        'text': f"{subject}\n\n{body}",
-                        'date': date_iso,
-                        'email_id': email_id,
-                        'subject': subject,
-                        'timestamp': timestamp
-                    })
-
-                except Exception as e:
-                    print(f"[ERROR] Processing email {email_id}: {e}")
+            items = []
+            for item in parse_fetch_response(data):
+                if item['uid'] is None:
                     continue
+                if '\\Seen' in item['flags']:
+                    logger.debug("Email %s already read, skipping", item['uid'])
+                    continue
+                item['body_part'] = find_text_part(parse_bodystructure(item['text']))
+                items.append(item)
+
+            bodies = await self._fetch_text_parts(imap_client, items)
+
+            # Разбор писем пачки идёт параллельно в пуле, цикл тем временем обслуживает остальной I/O
+            records = await asyncio.gather(*(
+                self._parse(
+                    build_record, item['uid'], fetch_section(item, 'BODY[HEADER'), bodies.get(item['uid']),
+                    item['body_part'], self.fetch_body_bytes, self.preview_length
+                )
+                for item in items
+            ), return_exceptions=True)
+
+            for item, record in zip(items, records):
+                if isinstance(record, Exception):
+                    logger.error("Processing email %s: %s", item['uid'], record)
+                    continue
+                if record is not None:
+                    fetched.append((item['uid'], item['flags'], record, item['body_part']))
+        return fetched
+
+    async def _fetch_text_parts(self, imap_client, items):
+        # Тянем только начало текстовой части, без вложений; один запрос на каждую секцию (обычно 1–2)
+        by_section = {}
+        for item in items:
+            if item['body_part'] is not None:
+                by_section.setdefault(item['body_part']['section'], []).append(item['uid'])
+
+        bodies = {}
+        for section, section_uids in by_section.items():
+            with metrics.stage('imap_fetch_body'):
+                status, data = await imap_client.uid(
+                    'fetch',
+                    format_uid_set(section_uids),
+                    f'(UID BODY.PEEK[{section}]<0.{self.fetch_body_bytes}>)'
+                )
+            if status != 'OK':
+                logger.error("Fetch of part %s failed: %s", section, data)
+                continue
+            for item in parse_fetch_response(data):
+                body = fetch_section(item, f'BODY[{section}]')
+                if item['uid'] is not None and body is not None:
+                    bodies[item['uid']] = body
+        return bodies
+
+    async def fetch_full_body(self, uid):
+        """Догружает полный текст одного письма по запросу (без вложений)."""
+        if not self.email_address or not self.email_password:
+            return None
 
-            await imap_client.logout()
-            messages.sort(key=lambda x: x['timestamp'], reverse=True)
-            self.messages = messages[:limit]
-            return self.messages
-
+        uid = int(uid)
+        body_part = self.store.get_body_part('INBOX', uid)
+        try:
+            async with self._imap_session() as imap_client:
+                if body_part is None:
+                    # Нет сведений о структуре — берём письмо целиком, как раньше
+                    status, data = await imap_client.uid('fetch', str(uid), '(UID BODY.PEEK[])')
+                    items = parse_fetch_response(data) if status == 'OK' else []
+                    raw = fetch_section(items[0], 'BODY[]') if items else None
+                    if raw is None:
+                        return None
+                    return await self._parse(message_text, raw)
+
+                section = body_part['section']
+                status, data = await imap_client.uid('fetch', str(uid), f'(UID BODY.PEEK[{section}])')
+                items = parse_fetch_response(data) if status == 'OK' else []
+                raw = fetch_section(items[0], f'BODY[{section}]') if items else None
         except Exception as e:
-            print(f"[CRITICAL] Error fetching email messages: {e}")
-            import traceback
-            traceback.print_exc()
-            return []
-
+            logger.error("Fetching full body of email %s: %s: %s", uid, type(e).__name__, e)
+            return None
+
+        if raw is None:
+            return None
+        return await self._parse(body_text, raw, body_part)
+
+    async def _connect_smtp(self):
+        await self._drop_smtp()
+        smtp_client = SMTP(
+            hostname=self.smtp_server,
+            port=self.smtp_port,
+            timeout=self.smtp_timeout,
+            use_tls=(self.smtp_port == 465),
+            start_tls=(self.smtp_port == 587)
+        )
+        # STARTTLS для 587 aiosmtplib выполняет сам внутри connect()
+        await smtp_client.connect()
+        await smtp_client.login(self.email_address, self.email_password)
+        self.smtp_client = smtp_client
+        logger.info("SMTP session established")
+
+        if self._smtp_keepalive_task is None or self._smtp_keepalive_task.done():
+            self._smtp_keepalive_task = asyncio.create_task(self._smtp_keepalive())
+        return smtp_client
+
+    async def _drop_smtp(self):
+        smtp_client, self.smtp_client = self.smtp_client, None
+        if smtp_client is None:
+            return
+        try:
+            await asyncio.wait_for(smtp_client.quit(), 5)
+        except Exception:
+            smtp_client.close()
+
+    async def _smtp_keepalive(self):
+        # NOOP не даёт серверу закрыть простаивающее соединение; при ошибке просто сбрасываем его
+        while self.smtp_client is not None:
+            await asyncio.sleep(self.smtp_keepalive)
+            async with self._smtp_lock:
+                if self.smtp_client is None:
+                    break
+                try:
+                    await self.smtp_client.noop()
+                except Exception as e:
+                    logger.info("SMTP keepalive failed (%s), will reconnect on next send", type(e).__name__)
+                    await self._drop_smtp()
 
     async def send_email(self, to_address, subject, body, in_reply_to=None):
         if not self.email_address or not self.email_password:
-            print("[ERROR] Email credentials missing")
+            logger.error("Email credentials missing")
             return False
 
-        try:
-            message = MIMEMultipart()
-            message['From'] = self.email_address
-            message['To'] = to_address
-            message['Subject'] = f"Re: {subject}" if in_reply_to else subject
-
-            if in_reply_to:
-                message['In-Reply-To'] = in_reply_to
-
-
-            message.attach(MIMEText(body, 'plain', 'utf-8'))
+        message = MIMEMultipart()
+        message['From'] = self.email_address
+        message['To'] = to_address
+        message['Subject'] = f"Re: {subject}" if in_reply_to else subject
 
-            smtp_client = SMTP(
-                hostname=self.smtp_server,
-                port=self.smtp_port,
-                timeout=120,
-                use_tls=(self.smtp_port == 465),
-                start_tls=(self.smtp_port == 587)
-            )
+        if in_reply_to:
+            message['In-Reply-To'] = in_reply_to
 
-            await smtp_client.connect()
+        message.attach(MIMEText(body, 'plain', 'utf-8'))
 
-            if self.smtp_port == 587:
-                await smtp_client.starttls()
-
-            await smtp_client.login(self.email_address, self.email_password)
-            await smtp_client.send_message(message)
-            await smtp_client.quit()
-
-            print(f"[INFO] Email sent successfully to {to_address}")
-            return True
-
-        except Exception as e:
-            print(f"[ERROR] Error sending email to {to_address}: {type(e).__name__}: {e}")
-            import traceback
-            traceback.print_exc()
-            return False
+        async with self._smtp_lock:
+            # Переиспользуем открытую SMTP-сессию; если сервер её закрыл — одна попытка переподключиться
+            for attempt in range(2):
+                try:
+                    smtp_client = self.smtp_client
+                    if smtp_client is None or not smtp_client.is_connected:
+                        smtp_client = await self._connect_smtp()
+                    with metrics.stage('smtp_send'):
+                        await smtp_client.send_message(message)
+                    logger.info("Email sent successfully to %s", to_address)
+                    return True
+                except (SMTPServerDisconnected, SMTPConnectError, OSError, asyncio.TimeoutError) as e:
+                    logger.error("SMTP session failed (attempt %d): %s: %s", attempt + 1, type(e).__name__, e)
+                    await self._drop_smtp()
+                except Exception as e:
+                    # Отказ сервера принять письмо — сессия жива, повтор решает очередь отправки
+                    logger.error("Error sending email to %s: %s: %s", to_address, type(e).__name__, e)
+                    return False
+        return False
 
     async def close(self):
-        """Безопасное завершение работы (если нужно вызвать извне)."""
-        pass  # В текущем коде соединения закрываются автоматически
+        """Безопасное завершение работы: закрывает IMAP- и SMTP-сессии и пул разбора писем."""
+        await self._acquire_imap()
+        try:
+            await self._drop_imap()
+        finally:
+            self._imap_lock.release()
+        async with self._smtp_lock:
+            await self._drop_smtp()
+        if self._smtp_keepalive_task is not None:
+            self._smtp_keepalive_task.cancel()
+        if self._parse_executor is not None:
+            self._parse_executor.shutdown(wait=False, cancel_futures=True)
+            self._parse_executor = None
@@ -0,0 +1,280 @@
+import re
+import html
+import time
+import email
+import logging
+import threading
+import email.policy
+import base64
+import quopri
+from email.header import decode_header
+from email.utils import parsedate_to_datetime, parseaddr
+from datetime import datetime
+from html.parser import HTMLParser
+from message import Message
+
+BASE64_JUNK_RE = re.compile(rb'[^A-Za-z0-9+/]')
+WHITESPACE_RE = re.compile(r'\s+')
+BLANK_LINES_RE = re.compile(r' ?\n\s*')
+# Теги, после которых в тексте начинается новая строка, и теги, содержимое которых не выводится
+HTML_BLOCK_TAGS = frozenset(('br', 'div', 'p', 'li', 'tr', 'td', 'th', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+                             'table', 'ul', 'ol', 'blockquote', 'pre', 'hr'))
+HTML_SKIP_TAGS = frozenset(('style', 'script', 'head', 'title', 'noscript', 'template'))
+HTML_FEED_CHUNK = 8192
+# Полное преобразование без limit — однопроходным сканером тегов: HTMLParser разбирает атрибуты
+# каждого тега в чистом Python и на больших рассылках в разы медленнее
+HTML_TOKEN_RE = re.compile(
+    r'<!--.*?(?:-->|$)'  # комментарий
+    r'|<(/?)([a-zA-Z][^\s/>]*)(?:[^>"\']|"[^"]*"|\'[^\']*\')*>'  # тег; ">" в кавычках атрибутов не закрывает его
+    r'|<[!?][^>]*>',  # doctype, инструкции обработки
+    re.S
+)
+HTML_SKIP_END_RE = {tag: re.compile(rf'</{tag}\s*>', re.I) for tag in HTML_SKIP_TAGS}
+HTML_BREAK = '\x00'
+HTML_BREAK_RE = re.compile(' ?\x00[\x00 ]*')
+
+logger = logging.getLogger(__name__)
+# Время этапов разбора в текущем потоке: воркер пула возвращает его вместе с результатом
+_stage_times = threading.local()
+
+
+def _add_stage_time(stage, seconds):
+    times = getattr(_stage_times, 'times', None)
+    if times is not None:
+        times[stage] = times.get(stage, 0.0) + seconds
+
+
+def run_timed(func, *args):
+    """Выполняет func(*args) и возвращает (результат, {этап: секунды}) — MIME и HTML отдельно.
+
+    Метрики, записанные в процессе пула (EMAIL_PARSE_EXECUTOR=process), до /metrics не дошли бы, поэтому время возвращается явно.
+    """
+    _stage_times.times = times = {}
+    started = time.perf_counter()
+    try:
+        result = func(*args)
+    finally:
+        _stage_times.times = None
+    total = time.perf_counter() - started
+    times['mime_parse'] = max(total - times.get('html_strip', 0.0), 0.0)
+    return result, times
+
+
+def decode_part(data, body_part):
+    encoding = body_part['encoding']
+    if encoding == 'BASE64':
+        # Частичная выборка может оборвать base64 на середине блока
+        compact = BASE64_JUNK_RE.sub(b'', data)
+        raw = base64.b64decode(compact[:len(compact) - len(compact) % 4])
+    elif encoding == 'QUOTED-PRINTABLE':
+        raw = quopri.decodestring(data)
+    else:
+        raw = data
+    try:
+        return raw.decode(body_part['charset'], errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+
+class _TextExtractor(HTMLParser):
+    """Однопроходный HTML -> текст: сущности декодирует сам HTMLParser, style/script пропускаются."""
+
+    def __init__(self, limit=None):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts = []
+        self.length = 0
+        self.skip = 0
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HTML_SKIP_TAGS:
+            self.skip += 1
+        elif tag in HTML_BLOCK_TAGS:
+            self._newline()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in HTML_BLOCK_TAGS:
+            self._newline()
+
+    def handle_endtag(self, tag):
+        if tag in HTML_SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in HTML_BLOCK_TAGS:
+            self._newline()
+
+    def handle_data(self, data):
+        if self.skip or self.done:
+            return
+        text = WHITESPACE_RE.sub(' ', data)
+        if text == ' ' and (not self.parts or self.parts[-1][-1:] in (' ', '\n')):
+            return
+        self.parts.append(text)
+        self.length += len(text)
+        if self.limit is not None and self.length >= self.limit:
+            self.done = True
+
+    def _newline(self):
+        if self.parts and self.parts[-1] != '\n':
+            self.parts.append('\n')
+            self.length += 1
+
+    def text(self):
+        text = BLANK_LINES_RE.sub('\n', ''.join(self.parts)).strip()
+        return text[:self.limit] if self.limit is not None else text
+
+
+def _html_to_text_full(markup):
+    # Текст между тегами собирается как есть, переводы строк блочных тегов — маркером HTML_BREAK;
+    # сущности и пробелы обрабатываются один раз для всего документа
+    markup = markup.replace(HTML_BREAK, '')
+    parts = []
+    pos = 0
+    while True:
+        match = HTML_TOKEN_RE.search(markup, pos)
+        if match is None:
+            parts.append(markup[pos:])
+            break
+        parts.append(markup[pos:match.start()])
+        pos = match.end()
+        tag = match.group(2)
+        if tag is None:
+            continue
+        tag = tag.lower()
+        if not match.group(1) and tag in HTML_SKIP_TAGS:
+            end = HTML_SKIP_END_RE[tag].search(markup, pos)
+            pos = end.end() if end else len(markup)
+        elif tag in HTML_BLOCK_TAGS:
+            parts.append(HTML_BREAK)
+    text = WHITESPACE_RE.sub(' ', html.unescape(''.join(parts)))
+    return HTML_BREAK_RE.sub('\n', text).strip()
+
+
+def html_to_text(markup, limit=None):
+    """Переводит HTML в текст за один проход; с limit разбор останавливается, как только набрано limit символов."""
+    if not markup:
+        return ""
+    started = time.perf_counter()
+    if limit is None:
+        text = _html_to_text_full(markup)
+        _add_stage_time('html_strip', time.perf_counter() - started)
+        return text
+    parser = _TextExtractor(limit)
+    # Скармливаем по кускам: у больших рассылок превью набирается задолго до конца документа
+    for start in range(0, len(markup), HTML_FEED_CHUNK):
+        parser.feed(markup[start:start + HTML_FEED_CHUNK])
+        if parser.done:
+            break
+    else:
+        parser.close()
+    text = parser.text()
+    _add_stage_time('html_strip', time.perf_counter() - started)
+    return text
+
+
+def decode_subject(subject):
+    if subject is None:
+        return "No Subject"
+    try:
+        decoded_parts = decode_header(subject)
+        decoded_subject = ""
+        for part, encoding in decoded_parts:
+            if isinstance(part, bytes):
+                decoded_subject += part.decode(encoding or 'utf-8', errors='replace')
+            else:
+                decoded_subject += str(part)
+        return decoded_subject
+    except Exception as e:
+        logger.warning("Decoding subject: %s", e)
+        return str(subject)
+
+
+def get_email_body(msg):
+    body = ""
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            content_disposition = str(part.get("Content-Disposition", "")).lower()
+
+            if content_type == "text/plain" and "attachment" not in content_disposition:
+                try:
+                    payload = part.get_payload(decode=True)
+                    if isinstance(payload, bytes):
+                        body = payload.decode('utf-8', errors='ignore')
+                    else:
+                        body = str(payload)
+                    break
+                except Exception as e:
+                    logger.warning("Decoding part: %s", e)
+                    continue
+    else:
+        try:
+            payload = msg.get_payload(decode=True)
+            if isinstance(payload, bytes):
+                body = payload.decode('utf-8', errors='ignore')
+            else:
+                body = str(payload)
+        except Exception as e:
+            logger.warning("Getting payload: %s", e)
+            body = str(msg.get_payload())
+    return body.strip()
+
+
+def build_record(uid, headers, raw_body, body_part, fetch_body_bytes, preview_length):
+    """Собирает компактную запись письма из заголовков и начала текстовой части.
+
+    Чистая функция без состояния — выполняется в пуле потоков или процессов, вне asyncio-цикла.
+    """
+    email_id = str(uid)
+    if not headers:
+        logger.debug("No headers found for ID %s, skipping", email_id)
+        return None
+
+    # Парсим заголовки
+    try:
+        msg = email.message_from_bytes(headers, policy=email.policy.default)
+    except Exception as e:
+        logger.error("Failed to parse headers for ID %s: %s", email_id, e)
+        return None
+
+    subject = decode_subject(msg.get('Subject', 'No Subject'))
+    from_addr = parseaddr(msg.get('From'))[1] or 'Unknown'
+    date_str = msg.get('Date', '')
+
+    # Парсим дату
+    try:
+        date_obj = parsedate_to_datetime(date_str)
+        if date_obj is None:
+            date_obj = datetime.now()
+        timestamp = date_obj.timestamp()
+    except (ValueError, TypeError, OverflowError) as e:
+        logger.warning("Parsing date %r: %s", date_str, e)
+        timestamp = datetime.now().timestamp()
+
+    # Тело приходит ограниченным по размеру фрагментом текстовой части — для превью этого достаточно
+    body = ""
+    partial = bool(raw_body) and len(raw_body) >= fetch_body_bytes
+    if raw_body and body_part:
+        body = decode_part(raw_body, body_part)
+        if body_part['subtype'] == 'html':
+            body = html_to_text(body, preview_length)
+            partial = partial or len(body) >= preview_length
+        else:
+            body = body.strip()
+
+    return Message(
+        f"email_msg_{email_id}", 'Email', from_addr, timestamp,
+        body=body, subject=subject, message_id=uid, partial=partial
+    )
+
+
+def body_text(raw, body_part):
+    """Полный текст одной текстовой части (для «Show full»)."""
+    text = decode_part(raw, body_part)
+    return html_to_text(text) if body_part['subtype'] == 'html' else text.strip()
+
+
+def message_text(raw):
+    """Текст письма целиком, когда структура частей неизвестна."""
+    msg = email.message_from_bytes(raw, policy=email.policy.default)
+    return html_to_text(get_email_body(msg))
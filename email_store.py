@@ -0,0 +1,112 @@
+import json
+import sqlite3
+import threading
+from message import Message
+
+
+class EmailStore:
+    """Локальное хранилище уже разобранных писем и состояния почтового ящика (SQLite)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS mailbox_state (
+                mailbox TEXT PRIMARY KEY,
+                uidvalidity INTEGER NOT NULL,
+                uidnext INTEGER,
+                highestmodseq INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                mailbox TEXT NOT NULL,
+                uid INTEGER NOT NULL,
+                flags TEXT NOT NULL DEFAULT '',
+                record TEXT NOT NULL,
+                body_part TEXT,
+                PRIMARY KEY (mailbox, uid)
+            );
+        ''')
+        try:
+            # Базы, созданные до появления частичной загрузки тела
+            self.conn.execute('ALTER TABLE messages ADD COLUMN body_part TEXT')
+        except sqlite3.OperationalError:
+            pass
+        self.conn.commit()
+
+    def get_state(self, mailbox):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT uidvalidity, uidnext, highestmodseq FROM mailbox_state WHERE mailbox = ?',
+                (mailbox,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'uidvalidity': row[0], 'uidnext': row[1], 'highestmodseq': row[2]}
+
+    def set_state(self, mailbox, uidvalidity, uidnext, highestmodseq):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO mailbox_state (mailbox, uidvalidity, uidnext, highestmodseq) '
+                'VALUES (?, ?, ?, ?)',
+                (mailbox, uidvalidity, uidnext, highestmodseq)
+            )
+
+    def reset(self, mailbox):
+        """Сбрасывает кэш ящика (например, при смене UIDVALIDITY)."""
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM messages WHERE mailbox = ?', (mailbox,))
+            self.conn.execute('DELETE FROM mailbox_state WHERE mailbox = ?', (mailbox,))
+
+    def uids(self, mailbox):
+        with self.lock:
+            rows = self.conn.execute('SELECT uid FROM messages WHERE mailbox = ?', (mailbox,)).fetchall()
+        return {row[0] for row in rows}
+
+    def load(self, mailbox, uids):
+        uids = list(uids)
+        if not uids:
+            return []
+        records = []
+        with self.lock:
+            # Ограничение SQLite на число параметров — читаем пачками
+            for i in range(0, len(uids), 500):
+                chunk = uids[i:i + 500]
+                rows = self.conn.execute(
+                    f'SELECT record FROM messages WHERE mailbox = ? AND uid IN ({",".join("?" * len(chunk))})',
+                    (mailbox, *chunk)
+                ).fetchall()
+                records.extend(Message.from_record(json.loads(row[0])) for row in rows)
+        return records
+
+    def save(self, mailbox, items):
+        """items: [(uid, flags, message, body_part)]"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO messages (mailbox, uid, flags, record, body_part) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (mailbox, uid, flags, json.dumps(record.to_record(), ensure_ascii=False),
+                     json.dumps(body_part) if body_part else None)
+                    for uid, flags, record, body_part in items
+                ]
+            )
+
+    def get_body_part(self, mailbox, uid):
+        """Где в письме лежит текстовая часть (секция, кодировка, charset) — для догрузки полного тела."""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT body_part FROM messages WHERE mailbox = ? AND uid = ?', (mailbox, uid)
+            ).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def delete(self, mailbox, uids):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'DELETE FROM messages WHERE mailbox = ? AND uid = ?',
+                [(mailbox, uid) for uid in uids]
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
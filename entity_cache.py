@@ -0,0 +1,88 @@
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class EntityCache:
+    """Имена пользователей и диалогов Telegram: LRU в памяти со сроком жизни, копия в SQLite.
+
+    После перезапуска имена берутся из базы, и новое сообщение показывается с именем отправителя
+    без запроса к Telegram. Запись старше ttl считается устаревшей и разрешается заново.
+    """
+
+    def __init__(self, path, max_size=1000, ttl=24 * 60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS entities (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        self.conn.commit()
+
+        # В память — только самые свежие записи, остальные подтянутся из базы по запросу
+        rows = self.conn.execute(
+            'SELECT id, name, updated_at FROM entities WHERE updated_at > ? ORDER BY updated_at DESC LIMIT ?',
+            (time.time() - ttl, max_size)
+        ).fetchall()
+        for entity_id, name, updated_at in reversed(rows):
+            self._entries[entity_id] = (name, updated_at)
+
+    def get(self, entity_id):
+        """Имя или None, если записи нет или она устарела."""
+        now = time.time()
+        with self.lock:
+            entry = self._entries.get(entity_id)
+            if entry is None:
+                row = self.conn.execute(
+                    'SELECT name, updated_at FROM entities WHERE id = ?', (entity_id,)
+                ).fetchone()
+                if row is None:
+                    return None
+                entry = tuple(row)
+            if now - entry[1] > self.ttl:
+                self._entries.pop(entity_id, None)
+                return None
+            self._entries[entity_id] = entry
+            self._entries.move_to_end(entity_id)
+            self._evict()
+            return entry[0]
+
+    def put(self, entity_id, name):
+        if not name:
+            return
+        now = time.time()
+        with self.lock:
+            entry = self._entries.get(entity_id)
+            self._entries[entity_id] = (name, now)
+            self._entries.move_to_end(entity_id)
+            self._evict()
+            # Обход диалогов повторяет одни и те же имена каждый цикл — в базу пишем только
+            # изменения и продление срока, когда прошла половина ttl
+            if entry is not None and entry[0] == name and now - entry[1] < self.ttl / 2:
+                self._entries[entity_id] = entry
+                return
+            with self.conn:
+                self.conn.execute(
+                    'INSERT INTO entities (id, name, updated_at) VALUES (?, ?, ?) '
+                    'ON CONFLICT(id) DO UPDATE SET name = excluded.name, updated_at = excluded.updated_at',
+                    (entity_id, name, now)
+                )
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
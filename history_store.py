@@ -0,0 +1,157 @@
+import json
+import logging
+import sqlite3
+import threading
+from message import Message
+
+TOKEN_SPLIT_CHARS = '"\'()*:^+-'
+
+logger = logging.getLogger(__name__)
+
+
+def build_match_query(query):
+    """Пользовательский запрос -> выражение FTS5: все слова обязательны, каждое ищется по префиксу."""
+    for char in TOKEN_SPLIT_CHARS:
+        query = query.replace(char, ' ')
+    return ' '.join(f'"{token}"*' for token in query.split())
+
+
+def sender_text(message):
+    """Текст колонки sender: имя контакта или чата и id/адрес отправителя, чтобы искать и по имени."""
+    parts = [str(part) for part in (message.source_name, message.sender) if part is not None and part != '']
+    return ' '.join(dict.fromkeys(parts))
+
+
+class HistoryStore:
+    """Архив всех когда-либо полученных сообщений (SQLite WAL) с полнотекстовым поиском FTS5."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS messages (
+                rowid INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                source TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                sender TEXT NOT NULL DEFAULT '',
+                subject TEXT NOT NULL DEFAULT '',
+                body TEXT NOT NULL DEFAULT '',
+                record TEXT NOT NULL
+            );
+        ''')
+        try:
+            # Индекс хранит только ссылки на строки messages; триггеры держат его в актуальном состоянии
+            self.conn.executescript('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    sender, subject, body,
+                    content='messages', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+                );
+                CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts (rowid, sender, subject, body)
+                    VALUES (new.rowid, new.sender, new.subject, new.body);
+                END;
+                CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, sender, subject, body)
+                    VALUES ('delete', old.rowid, old.sender, old.subject, old.body);
+                END;
+                CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, sender, subject, body)
+                    VALUES ('delete', old.rowid, old.sender, old.subject, old.body);
+                    INSERT INTO messages_fts (rowid, sender, subject, body)
+                    VALUES (new.rowid, new.sender, new.subject, new.body);
+                END;
+            ''')
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            # SQLite собран без FTS5 — поиск деградирует до LIKE
+            logger.warning("FTS5 unavailable (%s), history search falls back to LIKE", e)
+            self.fts = False
+        self.conn.commit()
+        self._migrate()
+
+    def _migrate(self):
+        # Версия 1: в sender добавлено имя контакта (раньше у Telegram там был только числовой id)
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] >= 1:
+            return
+        rows = self.conn.execute('SELECT rowid, record FROM messages').fetchall()
+        with self.conn:
+            self.conn.executemany(
+                'UPDATE messages SET sender = ? WHERE rowid = ?',
+                [(sender_text(Message.from_record(json.loads(record))), rowid) for rowid, record in rows]
+            )
+            self.conn.execute('PRAGMA user_version = 1')
+
+    def add(self, messages):
+        """Сохраняет или обновляет сообщения; неизменившиеся строки не перезаписываются."""
+        rows = [
+            (message.id, message.source, message.timestamp, sender_text(message), message.subject or '',
+             message.body or '', json.dumps(message.to_record(), ensure_ascii=False))
+            for message in messages
+        ]
+        if not rows:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT INTO messages (id, source, timestamp, sender, subject, body, record) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET source = excluded.source, timestamp = excluded.timestamp, '
+                'sender = excluded.sender, subject = excluded.subject, body = excluded.body, '
+                'record = excluded.record WHERE record != excluded.record',
+                rows
+            )
+
+    def get(self, message_id):
+        with self.lock:
+            row = self.conn.execute('SELECT record FROM messages WHERE id = ?', (message_id,)).fetchone()
+        return Message.from_record(json.loads(row[0])) if row else None
+
+    def search(self, query='', limit=20, before=None):
+        """Страница результатов, последние поступившие сверху: (messages, курсор следующей страницы или None).
+
+        Порядок — по rowid, то есть по времени попадания в архив: FTS5 отдаёт совпадения сразу
+        в этом порядке и останавливается на limit, не сортируя все найденное. before — курсор
+        из предыдущего ответа, без OFFSET.
+        """
+        conditions = []
+        params = []
+        match = build_match_query(query)
+        if match and self.fts:
+            source = 'messages_fts f JOIN messages m ON m.rowid = f.rowid'
+            conditions.append('messages_fts MATCH ?')
+            params.append(match)
+            order = 'f.rowid'
+        else:
+            source = 'messages m'
+            for token in query.split():
+                conditions.append('(m.sender LIKE ? OR m.subject LIKE ? OR m.body LIKE ?)')
+                params.extend([f'%{token}%'] * 3)
+            order = 'm.rowid'
+
+        if before:
+            try:
+                params.append(int(before))
+                conditions.append(f'{order} < ?')
+            except ValueError:
+                pass
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT m.rowid, m.record FROM {source} {where} ORDER BY {order} DESC LIMIT ?',
+                (*params, limit + 1)
+            ).fetchall()
+
+        next_cursor = str(rows[limit - 1][0]) if len(rows) > limit else None
+        return [Message.from_record(json.loads(row[1])) for row in rows[:limit]], next_cursor
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
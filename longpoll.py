@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from urllib.parse import urlsplit, parse_qs
+from compression import encode_body
+
+LONGPOLL_PATH = '/api/messages/wait'
+MAX_HEADER_LINES = 100
+
+logger = logging.getLogger(__name__)
+
+
+class LongPollServer:
+    """Минимальный HTTP-сервер на фоновом asyncio-цикле: держит запрос, пока не изменятся сообщения.
+
+    Ожидающий клиент стоит лишь корутину, а не поток Flask. render(since) возвращает
+    (changed, body) — есть ли изменения относительно курсора и JSON-ответ.
+    """
+
+    def __init__(self, render, max_timeout=55, gzip_min_bytes=1024):
+        self.render = render
+        self.max_timeout = max_timeout
+        self.gzip_min_bytes = gzip_min_bytes
+        self.loop = None
+        self.server = None
+        self._changed = None
+
+    def attach(self):
+        """Привязывает ожидание к текущему циклу событий. В ASGI-режиме отдельный порт не нужен —
+        запросы приходят через asgi.py и ждут в wait()."""
+        self.loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+
+    async def start(self, host, port):
+        self.attach()
+        self.server = await asyncio.start_server(self._handle, host, port)
+        logger.info("Long-poll server listening on %s:%s", host, port)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def notify(self):
+        """Вызывается из любого потока при изменении индекса сообщений."""
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        # Будим всех ожидающих и сразу готовим событие для следующего изменения
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def parse_timeout(self, value):
+        try:
+            return min(max(float(value), 0), self.max_timeout)
+        except (TypeError, ValueError):
+            return self.max_timeout
+
+    async def wait(self, since, timeout):
+        """Тело ответа, как только есть изменения относительно since, или текущий снимок через timeout секунд."""
+        deadline = self.loop.time() + timeout
+        while True:
+            # Событие берём до render, чтобы не пропустить изменение между ними
+            event = self._changed
+            changed, body = self.render(since)
+            remaining = deadline - self.loop.time()
+            if changed or remaining <= 0:
+                return body
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            accept_encoding = None
+            for _ in range(MAX_HEADER_LINES):
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'accept-encoding':
+                    accept_encoding = value.strip()
+
+            parts = request_line.decode('latin-1').split()
+            url = urlsplit(parts[1]) if len(parts) == 3 else None
+            if url is None or parts[0] != 'GET' or url.path != LONGPOLL_PATH:
+                self._respond(writer, '404 Not Found', b'{"error":"Not found"}')
+                return
+
+            params = parse_qs(url.query)
+            since = params.get('since', [''])[0]
+            timeout = self.parse_timeout(params.get('timeout', [None])[0])
+
+            body, compressed = encode_body(
+                await self.wait(since, timeout), accept_encoding, self.gzip_min_bytes
+            )
+            self._respond(writer, '200 OK', body, compressed)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error("Error in long-poll request: %s", e)
+        finally:
+            writer.close()
+
+    def _respond(self, writer, status, body, compressed=False):
+        encoding = "Content-Encoding: gzip\r\n" if compressed else ""
+        headers = (
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"{encoding}"
+            "Vary: Accept-Encoding\r\n"
+            "Cache-Control: no-store\r\n"
+            "X-Long-Poll: 1\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+        )
+        writer.write(headers.encode('latin-1') + body)
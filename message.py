@@ -0,0 +1,139 @@
+from datetime import datetime, timezone
+
+
+class Message:
+    """Сообщение любого источника.
+
+    Хранится только каноничное: время — одним timestamp, тема — отдельно от тела.
+    ISO-дата, полный текст и JSON для API вычисляются по запросу и кэшируются.
+    """
+
+    __slots__ = (
+        'id', 'source', 'source_name', 'sender_id', 'subject', 'body', 'timestamp',
+        'chat_id', 'message_id', 'partial', 'media', '_date', '_json'
+    )
+
+    def __init__(self, id, source, source_name, timestamp, body='', subject=None, sender_id=None,
+                 chat_id=None, message_id=None, partial=False, media=None):
+        self.id = id
+        self.source = source
+        self.source_name = source_name
+        self.sender_id = sender_id
+        self.subject = subject
+        self.body = body
+        self.timestamp = timestamp
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.partial = partial
+        # Вид вложения с миниатюрой ('photo', 'video', 'document'…); сами файлы догружаются по запросу
+        self.media = media
+        self._date = None
+        self._json = None
+
+    @property
+    def sender(self):
+        # У писем отправитель и есть источник; у Telegram — id пользователя
+        return self.sender_id if self.sender_id is not None else self.source_name
+
+    @property
+    def email_id(self):
+        return str(self.message_id) if self.source == 'Email' else None
+
+    @property
+    def text(self):
+        if self.subject is None:
+            return self.body
+        return f"{self.subject}\n\n{self.body}"
+
+    @property
+    def date(self):
+        if self._date is None:
+            self._date = datetime.fromtimestamp(self.timestamp, timezone.utc).isoformat()
+        return self._date
+
+    def _fields(self):
+        return (self.id, self.source, self.source_name, self.sender_id, self.subject, self.body,
+                self.timestamp, self.chat_id, self.message_id, self.partial, self.media)
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Message({self.id!r}, {self.source!r}, {self.timestamp!r})"
+
+    def __getstate__(self):
+        # Кэши не передаём в процессы разбора и обратно
+        return self._fields()
+
+    def __setstate__(self, state):
+        (self.id, self.source, self.source_name, self.sender_id, self.subject, self.body,
+         self.timestamp, self.chat_id, self.message_id, self.partial, self.media) = state
+        self._date = None
+        self._json = None
+
+    def to_json(self, preview_length=None):
+        """Словарь для API (с текстом, обрезанным до preview_length); строится один раз на длину превью."""
+        if self._json is not None and self._json[0] == preview_length:
+            return self._json[1]
+
+        text = self.text
+        truncated = self.partial
+        if preview_length is not None and len(text) > preview_length:
+            text = text[:preview_length] + '...'
+            truncated = True
+
+        data = {
+            'id': self.id,
+            'source': self.source,
+            'source_name': self.source_name,
+            'sender': self.sender,
+            'text': text,
+            'date': self.date,
+            'timestamp': self.timestamp,
+            'truncated': truncated
+        }
+        if self.source == 'Email':
+            data['email_id'] = self.email_id
+            data['subject'] = self.subject
+        else:
+            data['chat_id'] = self.chat_id
+            data['message_id'] = self.message_id
+        if self.media is not None:
+            data['media'] = self.media
+        self._json = (preview_length, data)
+        return data
+
+    def to_record(self):
+        """Компактная форма для хранения на диске."""
+        record = {'id': self.id, 'source': self.source, 'source_name': self.source_name,
+                  'body': self.body, 'timestamp': self.timestamp}
+        for name in ('subject', 'sender_id', 'chat_id', 'message_id', 'media'):
+            value = getattr(self, name)
+            if value is not None:
+                record[name] = value
+        if self.partial:
+            record['partial'] = True
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        body = record.get('body')
+        message_id = record.get('message_id')
+        if body is None:
+            # Запись старого формата: тема внутри text, uid — в email_id
+            subject = record.get('subject')
+            body = record.get('text', '')
+            prefix = f"{subject}\n\n"
+            if subject is not None and body.startswith(prefix):
+                body = body[len(prefix):]
+            if message_id is None and record.get('email_id'):
+                message_id = int(record['email_id'])
+        return cls(
+            record['id'], record['source'], record['source_name'], record['timestamp'], body=body,
+            subject=record.get('subject'), sender_id=record.get('sender_id'), chat_id=record.get('chat_id'),
+            message_id=message_id, partial=record.get('partial', False), media=record.get('media')
+        )
@@ -0,0 +1,194 @@
+﻿import time
+import logging
+import threading
+from sortedcontainers import SortedKeyList
+
+logger = logging.getLogger(__name__)
+
+
+def _sort_key(message):
+    # Новые сверху; id разводит сообщения с одинаковым временем
+    return (-message.timestamp, message.id)
+
+
+def format_cursor(message):
+    return f"{message.timestamp!r},{message.id}"
+
+
+def parse_cursor(cursor):
+    """'<timestamp>,<id>' -> ключ сортировки, после которого начинается следующая страница."""
+    timestamp, _, message_id = (cursor or '').partition(',')
+    try:
+        return (-float(timestamp), message_id)
+    except ValueError:
+        return None
+
+
+def _sender_key(message):
+    return str(message.sender).lower()
+
+
+class MessageIndex:
+    """Сообщения всех источников, отсортированные по времени, с поиском по id за O(1).
+
+    Для фильтров по источнику, отправителю и чату держим отдельные отсортированные списки,
+    так что страница выборки не требует просмотра всего индекса.
+    """
+
+    def __init__(self, max_size=200):
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self._by_time = SortedKeyList(key=_sort_key)
+        self._by_id = {}
+        self._by_source = {}
+        self._by_sender = {}
+        self._by_chat = {}
+        # Версия растёт при каждом изменении — по ней кэшируются ответы API
+        self.version = 0
+        self.updated_at = time.time()
+        self._listeners = []
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, message_id):
+        return message_id in self._by_id
+
+    def get(self, message_id):
+        with self.lock:
+            return self._by_id.get(message_id)
+
+    def latest(self, limit=None):
+        with self.lock:
+            if limit is None:
+                return list(self._by_time)
+            return list(self._by_time.islice(0, limit))
+
+    def chat_messages(self, chat_id):
+        """Все сообщения чата в индексе, новые сверху."""
+        with self.lock:
+            return list(self._by_chat.get(str(chat_id), ()))
+
+    def page(self, limit, before=None, source=None, sender=None, chat_id=None):
+        """Страница новых-сверху сообщений после курсора before с фильтрами: (messages, курсор или None)."""
+        with self.lock:
+            # Обходим самый узкий из подходящих списков, остальные условия проверяем по ходу
+            if chat_id is not None:
+                candidates = self._by_chat.get(str(chat_id), ())
+            elif sender is not None:
+                candidates = self._by_sender.get(sender.lower(), ())
+            elif source is not None:
+                candidates = self._by_source.get(source, ())
+            else:
+                candidates = self._by_time
+            if not candidates:
+                return [], None
+
+            start = parse_cursor(before) if before else None
+            if start is not None:
+                candidates = candidates.irange_key(min_key=start, inclusive=(False, False))
+
+            messages = []
+            for message in candidates:
+                if source is not None and message.source != source:
+                    continue
+                if sender is not None and _sender_key(message) != sender.lower():
+                    continue
+                if len(messages) == limit:
+                    return messages, format_cursor(messages[-1])
+                messages.append(message)
+            return messages, None
+
+    def snapshot(self, limit=None):
+        """Согласованные версия, время изменения и сообщения."""
+        with self.lock:
+            return self.version, self.updated_at, self.latest(limit)
+
+    def add_listener(self, callback):
+        """callback() вызывается после каждого изменения, вне блокировки индекса."""
+        self._listeners.append(callback)
+
+    def add(self, message):
+        with self.lock:
+            changed = self._add(message)
+        return self._notify(changed)
+
+    def remove(self, message_id):
+        with self.lock:
+            changed = self._remove(message_id)
+        return self._notify(changed)
+
+    def update(self, added=(), removed=()):
+        """Точечные изменения одного источника (например, события Telegram)."""
+        with self.lock:
+            changed = False
+            for message_id in removed:
+                changed = self._remove(message_id) or changed
+            for message in added:
+                changed = self._add(message) or changed
+        return self._notify(changed)
+
+    def replace_source(self, source, messages):
+        """Приводит сообщения источника к новому списку: удаляет пропавшие, добавляет и обновляет остальные."""
+        with self.lock:
+            new_ids = {message.id for message in messages}
+            changed = False
+            old_ids = {message.id for message in self._by_source.get(source, ())}
+            for message_id in old_ids - new_ids:
+                changed = self._remove(message_id) or changed
+            for message in messages:
+                changed = self._add(message) or changed
+        return self._notify(changed)
+
+    def _notify(self, changed):
+        if changed:
+            for callback in self._listeners:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error("Error in message index listener: %s", e)
+        return changed
+
+    def _add(self, message):
+        existing = self._by_id.get(message.id)
+        if existing is not None:
+            if existing == message:
+                return False
+            self._remove(message.id)
+        elif len(self._by_id) >= self.max_size and _sort_key(message) > _sort_key(self._by_time[-1]):
+            # Индекс заполнен, а сообщение старее всех — не вставляем, чтобы не вытеснять его снова
+            return False
+
+        self._by_time.add(message)
+        self._by_id[message.id] = message
+        for index, key in self._secondary_keys(message):
+            if key not in index:
+                index[key] = SortedKeyList(key=_sort_key)
+            index[key].add(message)
+
+        while len(self._by_time) > self.max_size:
+            self._remove(self._by_time[-1].id)
+        self._touch()
+        return True
+
+    def _remove(self, message_id):
+        message = self._by_id.pop(message_id, None)
+        if message is None:
+            return False
+        self._by_time.remove(message)
+        for index, key in self._secondary_keys(message):
+            index[key].remove(message)
+            if not index[key]:
+                del index[key]
+        self._touch()
+        return True
+
+    def _secondary_keys(self, message):
+        yield self._by_source, message.source
+        yield self._by_sender, _sender_key(message)
+        if message.chat_id is not None:
+            yield self._by_chat, str(message.chat_id)
+
+    def _touch(self):
+        self.version += 1
+        self.updated_at = time.time()
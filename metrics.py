@@ -0,0 +1,67 @@
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+# От миллисекунды (разбор одного письма, сериализация) до минут (полный цикл опроса)
+STAGE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Этапы: imap_connect, imap_login, imap_select, imap_search, imap_fetch, imap_fetch_body, mime_parse,
+# html_strip, telegram_dialog_scan, telegram_dialog_fetch, merge, api_serialize, history_search, smtp_send,
+# thumbnail
+STAGE_SECONDS = Histogram(
+    'aggregator_stage_duration_seconds', 'Время отдельных этапов опроса, разбора и API',
+    ['stage'], buckets=STAGE_BUCKETS
+)
+POLL_SECONDS = Histogram(
+    'aggregator_poll_cycle_duration_seconds', 'Полное время цикла опроса источника',
+    ['source'], buckets=STAGE_BUCKETS
+)
+POLL_CYCLES = Counter('aggregator_poll_cycles', 'Циклы опроса по источникам и результату', ['source', 'result'])
+MESSAGES_FETCHED = Counter('aggregator_messages_fetched', 'Сообщений получено циклами опроса', ['source'])
+HTTP_SECONDS = Histogram(
+    'aggregator_http_request_duration_seconds', 'Время обработки HTTP-запросов Flask',
+    ['endpoint'], buckets=STAGE_BUCKETS
+)
+HTTP_REQUESTS = Counter('aggregator_http_requests', 'HTTP-запросы Flask', ['endpoint', 'method', 'status'])
+OUTBOX_JOBS = Counter('aggregator_outbox_jobs', 'Завершённые задания отправки', ['status'])
+MESSAGE_INDEX_SIZE = Gauge('aggregator_message_index_size', 'Сообщений в общем индексе')
+
+
+def stage(name):
+    """with stage('imap_fetch'): ... — время блока попадает в гистограмму этапов."""
+    return STAGE_SECONDS.labels(name).time()
+
+
+def observe_stage(name, seconds):
+    STAGE_SECONDS.labels(name).observe(seconds)
+
+
+class PollerCollector:
+    """Текущее состояние планировщиков опроса: читается из SourcePoller в момент запроса /metrics."""
+
+    def __init__(self, pollers):
+        self.pollers = pollers
+
+    def collect(self):
+        interval = GaugeMetricFamily(
+            'aggregator_poll_interval_seconds', 'Текущая пауза между циклами опроса', labels=['source'])
+        failures = GaugeMetricFamily(
+            'aggregator_poll_consecutive_failures', 'Неудачных циклов подряд', labels=['source'])
+        last_success = GaugeMetricFamily(
+            'aggregator_poll_last_success_timestamp_seconds', 'Время последнего успешного цикла', labels=['source'])
+        for name, poller in list(self.pollers.items()):
+            interval.add_metric([name], poller.current_interval)
+            failures.add_metric([name], poller.failures)
+            if poller.last_success is not None:
+                last_success.add_metric([name], poller.last_success)
+        yield interval
+        yield failures
+        yield last_success
+
+
+def register_pollers(pollers):
+    REGISTRY.register(PollerCollector(pollers))
+
+
+def render():
+    """(тело, Content-Type) в текстовом формате Prometheus."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
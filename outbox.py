@@ -0,0 +1,130 @@
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """Очередь исходящих сообщений на фоновом asyncio-цикле.
+
+    submit() сразу возвращает id задания; доставка, повторы и статус — здесь,
+    поэтому HTTP-запрос не ждёт SMTP или Telegram.
+    """
+
+    def __init__(self, max_attempts=3, retry_delay=5, history=500):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.history = history
+        self.loop = None
+        self.lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._queue = None
+        self._worker = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    @property
+    def ready(self):
+        """Принимает ли задания: до start() и после stop() submit() их не примет."""
+        return self._worker is not None
+
+    async def stop(self, timeout=10):
+        """Даёт уже поставленным в очередь заданиям до timeout секунд на доставку и останавливает воркер."""
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Outbox stopped with %d undelivered jobs", self._queue.qsize())
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+    def submit(self, send, description=''):
+        """send — функция без аргументов, возвращающая корутину с результатом True/False.
+
+        Можно вызывать из любого потока.
+        """
+        if not self.ready:
+            raise RuntimeError('Outbox is not started')
+
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'description': description,
+            'attempts': 0,
+            'error': None,
+            'created_at': time.time(),
+            'updated_at': time.time(),
+        }
+        with self.lock:
+            self._jobs[job['id']] = job
+            # Храним только последние задания — статус нужен клиенту лишь до доставки
+            while len(self._jobs) > self.history:
+                self._jobs.popitem(last=False)
+            # Копия до постановки в очередь: воркер может сразу поменять статус задания
+            result = dict(job)
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, (job['id'], send))
+        return result
+
+    def status(self, job_id):
+        with self.lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _set(self, job_id, **fields):
+        with self.lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updated_at=time.time())
+            return job
+
+    async def _run(self):
+        while True:
+            job_id, send = await self._queue.get()
+            try:
+                await self._deliver(job_id, send)
+            except Exception as e:
+                logger.error("Error in outbox worker: %s", e)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, job_id, send):
+        job = self._set(job_id, status='sending')
+        if job is None:
+            return
+
+        attempt = job['attempts'] + 1
+        try:
+            success = await send()
+            error = None if success else 'Failed to send message'
+        except Exception as e:
+            success, error = False, str(e)
+
+        if success:
+            self._set(job_id, status='sent', attempts=attempt, error=None)
+            metrics.OUTBOX_JOBS.labels('sent').inc()
+            return
+
+        if attempt >= self.max_attempts:
+            logger.error("Outbox job %s failed after %d attempts: %s", job_id, attempt, error)
+            self._set(job_id, status='failed', attempts=attempt, error=error)
+            metrics.OUTBOX_JOBS.labels('failed').inc()
+            return
+
+        # Повтор с растущей паузой, не занимая воркер на время ожидания
+        delay = self.retry_delay * 2 ** (attempt - 1)
+        logger.info("Outbox job %s attempt %d failed (%s), retrying in %ss", job_id, attempt, error, delay)
+        self._set(job_id, status='retrying', attempts=attempt, error=error)
+        self.loop.call_later(delay, self._queue.put_nowait, (job_id, send))
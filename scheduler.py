@@ -0,0 +1,113 @@
+import time
+import asyncio
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SourcePoller:
+    """Независимый цикл опроса одного источника.
+
+    fetch() — корутина, возвращающая список сообщений источника; корутина on_result(messages)
+    вливает их в общий набор сразу по завершении цикла. Каждый цикл ограничен timeout; после ошибок
+    пауза растёт экспоненциально, а пока приходят новые сообщения — интервал сокращается
+    до min_interval и плавно возвращается к interval, когда поток затихает.
+
+    wait(timeout) — необязательное ожидание между циклами (например, IMAP IDLE): возвращает
+    True, если источник сам сообщил об изменениях и опросить его нужно сразу.
+    """
+
+    def __init__(self, name, fetch, on_result, interval, timeout, min_interval=None,
+                 backoff_base=30, max_backoff=30 * 60, wait=None):
+        self.name = name
+        self.fetch = fetch
+        self.on_result = on_result
+        self.interval = interval
+        self.timeout = timeout
+        self.min_interval = min(min_interval or interval, interval)
+        self.backoff_base = backoff_base
+        self.max_backoff = max(max_backoff, backoff_base)
+        self.wait = wait
+        self.current_interval = interval
+        self.failures = 0
+        self.last_success = None
+        self.last_error = None
+        self.last_duration = None
+        self._seen_ids = None
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name=f"poll-{self.name}")
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            delay = await self._cycle()
+            await self._sleep(delay)
+
+    async def _cycle(self):
+        started = time.monotonic()
+        try:
+            messages = await asyncio.wait_for(self.fetch(), self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            self.last_error = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+            delay = min(self.backoff_base * 2 ** (self.failures - 1), self.max_backoff)
+            result = 'timeout' if isinstance(e, asyncio.TimeoutError) else 'error'
+            metrics.POLL_CYCLES.labels(self.name, result).inc()
+            logger.warning("%s: cycle failed (%s), failure %d, retrying in %.0fs",
+                           self.name, self.last_error, self.failures, delay)
+            return delay
+        finally:
+            self.last_duration = time.monotonic() - started
+            metrics.POLL_SECONDS.labels(self.name).observe(self.last_duration)
+
+        self.failures = 0
+        self.last_error = None
+        self.last_success = time.time()
+        metrics.POLL_CYCLES.labels(self.name, 'ok').inc()
+        metrics.MESSAGES_FETCHED.labels(self.name).inc(len(messages))
+
+        ids = {message.id for message in messages}
+        arrived = self._seen_ids is not None and bool(ids - self._seen_ids)
+        self._seen_ids = ids
+        if arrived:
+            self.current_interval = max(self.min_interval, self.current_interval / 2)
+        else:
+            self.current_interval = min(self.interval, self.current_interval * 2)
+
+        try:
+            await self.on_result(messages)
+        except Exception as e:
+            logger.error("%s: error merging results: %s", self.name, e)
+
+        logger.info("%s: %d messages in %.2fs, next in %.0fs",
+                    self.name, len(messages), self.last_duration, self.current_interval)
+        return self.current_interval
+
+    async def _sleep(self, delay):
+        if self.wait is None or self.failures:
+            await asyncio.sleep(delay)
+            return
+        started = time.monotonic()
+        try:
+            # wait() сам ограничен delay — запас, чтобы не обрывать его на полуслове (IDLE завершается DONE)
+            if await asyncio.wait_for(self.wait(delay), delay + 15):
+                logger.info("%s: change notification, polling now", self.name)
+        except asyncio.TimeoutError:
+            pass
+        except Exception as e:
+            logger.error("%s: wait failed: %s", self.name, e)
+            # Без этого сбой ожидания сразу же запускал бы следующий цикл
+            await asyncio.sleep(max(delay - (time.monotonic() - started), 0))
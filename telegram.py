@@ -1,13 +1,45 @@
 ﻿import os
+import time
 import asyncio
+import logging
 from telethon.tl.types import User
 from datetime import datetime
-from telethon import TelegramClient, events
-from telethon.tl.types import Message, User
+from telethon import TelegramClient, events, utils
+from telethon.errors import FloodWaitError
 from dotenv import load_dotenv
+from message import Message
+from entity_cache import EntityCache
+import metrics
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+def media_kind(message):
+    """Вид вложения, для которого есть миниатюра; None — медиа нет или показать нечего."""
+    if message.photo:
+        return 'photo'
+    document = message.document
+    if document is None or not document.thumbs:
+        return None
+    if message.video or message.gif:
+        return 'video'
+    if message.sticker:
+        return 'sticker'
+    return 'document'
+
+
+def pick_photo_size(sizes, target):
+    """Наименьший размер, у которого большая сторона не меньше target, иначе самый крупный."""
+    # Размеры без w/h (stripped, path) — служебные превью в пару сотен байт
+    sized = sorted((size for size in sizes if getattr(size, 'w', 0) and getattr(size, 'h', 0)),
+                   key=lambda size: max(size.w, size.h))
+    for size in sized:
+        if max(size.w, size.h) >= target:
+            return size
+    return sized[-1] if sized else None
+
 class TelegramHandler:
     def __init__(self):
         api_id_str = os.getenv('TELEGRAM_API_ID')
@@ -19,57 +51,196 @@ class TelegramHandler:
         self.messages = []
         self.last_check = None
 
+        # Параллельный опрос диалогов: сколько диалогов читаем одновременно
+        self.fetch_concurrency = max(1, int(os.getenv('TELEGRAM_FETCH_CONCURRENCY', '8')))
+        self.flood_wait_max = int(os.getenv('TELEGRAM_FLOOD_WAIT_MAX_SECONDS', '120'))
+        self.flood_retries = 3
+        self._flood_until = 0.0
+
+        # Обновления приходят через события Telethon; полный обход диалогов — только сверка
+        self.on_change = None
+        # Сообщения чата в общем индексе: self.messages обрезан до limit, а индекс хранит больше
+        self.chat_messages = None
+        self.events_enabled = False
+        self.limit = 10
+
+        # Имена пользователей и диалогов: не запрашиваем их заново на каждое событие и после перезапуска
+        self.entities = EntityCache(
+            os.getenv('TELEGRAM_ENTITY_CACHE_PATH', 'telegram_entities.sqlite3'),
+            max_size=int(os.getenv('TELEGRAM_ENTITY_CACHE_SIZE', '1000')),
+            ttl=int(os.getenv('TELEGRAM_ENTITY_CACHE_HOURS', '24')) * 60 * 60
+        )
+
     async def start(self):
         if not self.api_id or not self.api_hash or not self.phone:
-            print("WARNING: Telegram credentials not configured. Skipping Telegram integration.")
+            logger.warning("Telegram credentials not configured. Skipping Telegram integration.")
             return False
 
         try:
             self.client = TelegramClient(self.session_name, self.api_id, self.api_hash)
             await self.client.start(phone=self.phone)
-            print("Telegram client started successfully")
+            self.client.add_event_handler(
+                self._on_new_message, events.NewMessage(incoming=True, func=lambda e: e.is_private)
+            )
+            self.client.add_event_handler(self._on_message_read, events.MessageRead(inbox=True))
+            self.events_enabled = True
+            logger.info("Telegram client started successfully")
             return True
         except Exception as e:
-            print(f"Error starting Telegram client: {e}")
+            logger.error("Error starting Telegram client: %s", e)
             return False
 
     async def fetch_messages(self, limit=10):
-        if not self.client or not self.client.is_connected():
+        if not self.api_id or not self.api_hash or not self.phone:
             return []
-        
+        if not self.client or not self.client.is_connected():
+            # Пустой список стёр бы сообщения Telegram из индекса до следующей сверки —
+            # ошибка же оставляет их на месте, а планировщик откладывает повтор
+            raise ConnectionError("Telegram client is not connected")
+
         try:
+            started = time.monotonic()
+            # Получаем только личные диалоги с непрочитанными сообщениями
+            with metrics.stage('telegram_dialog_scan'):
+                dialogs = [
+                    dialog async for dialog in self.client.iter_dialogs()
+                    if isinstance(dialog.entity, User) and dialog.unread_count > 0
+                ]
+            scan_time = time.monotonic() - started
+            for dialog in dialogs:
+                self.entities.put(dialog.id, dialog.name)
+
+            # Сообщения диалогов запрашиваем параллельно, не больше fetch_concurrency одновременно
+            semaphore = asyncio.Semaphore(self.fetch_concurrency)
+            results = await asyncio.gather(*(
+                self._fetch_dialog(dialog, min(dialog.unread_count, limit), semaphore)
+                for dialog in dialogs
+            ))
             messages = []
-            # Получаем только личные диалоги
-            async for dialog in self.client.iter_dialogs():
-                if isinstance(dialog.entity, User):
-                    # Проверяем наличие непрочитанных сообщений в диалоге
-                    if dialog.unread_count > 0:
-                        try:
-                            # Берём только первые непрочитанные сообщения
-                            async for message in self.client.iter_messages(dialog, limit=dialog.unread_count):
-                                if message.text:
-                                    messages.append({
-                                        'id': f"tg_{dialog.id}_{message.id}",
-                                        'source': 'Telegram',
-                                        'source_name': dialog.name or 'Unknown',
-                                        'sender': message.sender_id,
-                                        'text': message.text,
-                                        'date': message.date.isoformat() if message.date else datetime.now().isoformat(),
-                                        'chat_id': dialog.id,
-                                        'message_id': message.id,
-                                        'timestamp': message.date.timestamp() if message.date else datetime.now().timestamp()
-                                    })
-                        except Exception as e:
-                            print(f"Error fetching messages from dialog {dialog.id}: {e}")
-                            continue
-            
-            messages.sort(key=lambda x: x['timestamp'], reverse=True)
+            for dialog, dialog_messages in zip(dialogs, results):
+                if dialog_messages is None:
+                    # Диалог не прочитан (FloodWait, ошибка): оставляем его прежние сообщения,
+                    # иначе replace_source убрал бы их из индекса до следующей сверки
+                    dialog_messages = self._known_messages(dialog.id)
+                messages.extend(dialog_messages)
+
+            logger.debug("Telegram: %d unread dialogs, scan %.2fs, total %.2fs (concurrency %d)",
+                         len(dialogs), scan_time, time.monotonic() - started, self.fetch_concurrency)
+
+            messages.sort(key=lambda x: x.timestamp, reverse=True)
+            self.limit = limit
             self.messages = messages[:limit]
             return self.messages
         
         except Exception as e:
-            print(f"Error fetching Telegram messages: {e}")
-            return []
+            logger.error("Error fetching Telegram messages: %s", e)
+            raise
+
+    def _known_messages(self, chat_id):
+        """Сообщения чата, которые уже показаны: из своего списка и из общего индекса."""
+        known = self.messages
+        if self.chat_messages is not None:
+            known = [*known, *self.chat_messages(chat_id)]
+        return list({m.id: m for m in known if m.source == 'Telegram' and m.chat_id == chat_id}.values())
+
+    async def _wait_flood(self):
+        # FloodWait действует на весь аккаунт — пока он не истёк, новые запросы не отправляем
+        delay = self._flood_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _fetch_dialog(self, dialog, limit, semaphore):
+        """Сообщения диалога или None, если прочитать его в этом цикле не удалось."""
+        async with semaphore:
+            for attempt in range(self.flood_retries):
+                await self._wait_flood()
+                started = time.monotonic()
+                try:
+                    messages = []
+                    # Берём только первые непрочитанные сообщения
+                    # Медиа без подписи тоже показываем: файл не качаем, миниатюра — по запросу страницы
+                    async for message in self.client.iter_messages(dialog, limit=limit):
+                        if message.text or media_kind(message):
+                            messages.append(self._build_message(dialog.id, dialog.name, message))
+                    elapsed = time.monotonic() - started
+                    metrics.observe_stage('telegram_dialog_fetch', elapsed)
+                    logger.debug("Dialog %s: %d messages in %.2fs", dialog.id, len(messages), elapsed)
+                    return messages
+                except FloodWaitError as e:
+                    if e.seconds > self.flood_wait_max:
+                        logger.warning("FloodWait %ss on dialog %s exceeds limit, skipping this cycle",
+                                       e.seconds, dialog.id)
+                        return None
+                    # Ждём требуемое время плюс растущий запас перед повтором
+                    delay = e.seconds + 2 ** attempt
+                    logger.warning("FloodWait on dialog %s: retrying in %ss", dialog.id, delay)
+                    self._flood_until = max(self._flood_until, time.monotonic() + delay)
+                except Exception as e:
+                    logger.error("Error fetching messages from dialog %s: %s", dialog.id, e)
+                    return None
+            return None
+
+    def _notify(self, added=(), removed=()):
+        if self.on_change is not None:
+            try:
+                self.on_change(added, removed)
+            except Exception as e:
+                logger.error("Error in Telegram change callback: %s", e)
+
+    async def _on_new_message(self, event):
+        message = event.message
+        if not message.text and not media_kind(message):
+            return
+        chat_name = self.entities.get(event.chat_id)
+        if chat_name is None:
+            try:
+                chat = await event.get_chat()
+                chat_name = utils.get_display_name(chat)
+                self.entities.put(event.chat_id, chat_name)
+            except Exception as e:
+                logger.warning("Error resolving chat %s: %s", event.chat_id, e)
+
+        new_message = self._build_message(event.chat_id, chat_name, message)
+        messages = [m for m in self.messages if m.id != new_message.id]
+        messages.append(new_message)
+        messages.sort(key=lambda x: x.timestamp, reverse=True)
+        self.messages = messages[:self.limit]
+        self._notify(added=[new_message])
+
+    async def _on_message_read(self, event):
+        # Прочитано на другом устройстве: убираем всё до max_id включительно
+        read_ids = [m.id for m in self._known_messages(event.chat_id) if m.message_id <= event.max_id]
+        if read_ids:
+            self.messages = [m for m in self.messages if m.id not in read_ids]
+            self._notify(removed=read_ids)
+
+    def _build_message(self, chat_id, chat_name, message):
+        return Message(
+            f"tg_{chat_id}_{message.id}", 'Telegram', chat_name or 'Unknown',
+            message.date.timestamp() if message.date else datetime.now().timestamp(),
+            body=message.text or '', sender_id=message.sender_id, chat_id=chat_id, message_id=message.id,
+            media=media_kind(message)
+        )
+
+    async def download_thumbnail(self, chat_id, message_id, target=960):
+        """Байты миниатюры фото или видео, подходящей для экрана со стороной target; None — медиа нет."""
+        if not self.client or not self.client.is_connected():
+            return None
+
+        await self._wait_flood()
+        message = await self.client.get_messages(int(chat_id), ids=int(message_id))
+        if message is None:
+            return None
+        if message.photo:
+            sizes = message.photo.sizes
+        elif message.document is not None:
+            sizes = message.document.thumbs or []
+        else:
+            return None
+        size = pick_photo_size(sizes, target)
+        if size is None:
+            return None
+        return await self.client.download_media(message, file=bytes, thumb=size.type)
 
     async def send_message(self, chat_id, message_id, text):
         if not self.client or not self.client.is_connected():
@@ -79,7 +250,7 @@ class TelegramHandler:
             await self.client.send_message(int(chat_id), text, reply_to=int(message_id))
             return True
         except Exception as e:
-            print(f"Error sending Telegram message: {e}")
+            logger.error("Error sending Telegram message: %s", e)
             return False
 
     async def save_to_favorites(self, text):
@@ -90,7 +261,7 @@ class TelegramHandler:
             await self.client.send_message('me', text)
             return True
         except Exception as e:
-            print(f"Error saving to Telegram favorites: {e}")
+            logger.error("Error saving to Telegram favorites: %s", e)
             return False
 
     async def stop(self):
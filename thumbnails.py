@@ -0,0 +1,63 @@
+import io
+import os
+from PIL import Image, ImageOps
+
+
+def make_thumbnail(data, max_size=(640, 960), quality=70):
+    """JPEG не больше max_size (ширина, высота) из байтов любого формата, который понимает Pillow."""
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        image.thumbnail(max_size)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # Прозрачность (стикеры, PNG) — на белом фоне, как на странице
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    """Уменьшенные копии медиа на диске: один JPEG на сообщение, сверх max_files удаляются самые старые."""
+
+    def __init__(self, directory, max_size=(640, 960), quality=70, max_files=1000):
+        self.directory = directory
+        self.max_size = max_size
+        self.quality = quality
+        self.max_files = max_files
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.jpg")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        """Уменьшает исходные байты, сохраняет результат и возвращает его."""
+        thumbnail = make_thumbnail(data, self.max_size, self.quality)
+        path = self._path(key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(thumbnail)
+        os.replace(path + '.tmp', path)
+        self._evict()
+        return thumbnail
+
+    def _evict(self):
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.jpg')]
+        if len(entries) <= self.max_files:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_files]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass